@@ -6,11 +6,17 @@ walk through the notebooks and you will find instructions on *when* to implement
 """
 
 
+import collections
+import functools
+import hashlib
+import itertools
 import math
-from typing import Dict, List, Optional
+import os
+from typing import Dict, List, NamedTuple, Optional
 
 import torch
 from cs639.loading import *
+from cs639.utils import set_cpu_threads
 from torch import nn
 from torch.nn import functional as F
 from torch.utils.data._utils.collate import default_collate
@@ -174,6 +180,8 @@ def get_fpn_location_coords(
     represents the center of the receptive field of this location. We need to
     do this for having a uniform co-ordinate representation of all the locations
     across FPN levels, and GT boxes.
+    NOTE: Location tensors are memoized (see `_get_location_grid`) and shared
+    between calls, DO NOT modify them in-place.
     Args:
         shape_per_fpn_level: Shape of the FPN feature level, dictionary of keys
             {"p3", "p4", "p5"} and feature shapes `(B, C, H, W)` as values.
@@ -201,20 +209,115 @@ def get_fpn_location_coords(
         # Replace "PASS" statement with your code
         H, W = feat_shape[2],feat_shape[3]
 
-        xc, yc = torch.meshgrid( torch.arange(H, device=device, dtype=dtype),
-            torch.arange(W, device=device, dtype=dtype))
-
-        xc = xc * level_stride + level_stride * 0.5
-        yc = yc * level_stride + level_stride * 0.5
-
-        location_coords[level_name] = torch.stack([xc, yc], dim=-1).view(-1, 2) 
+        location_coords[level_name] = _get_location_grid(
+            H, W, level_stride, dtype, torch.device(device)
+        )
         ######################################################################
         #                             END OF YOUR CODE                       #
         ######################################################################
     return location_coords
 
 
-def nms(boxes: torch.Tensor, scores: torch.Tensor, iou_threshold: float = 0.5):
+@functools.lru_cache(maxsize=32)
+def _get_location_grid(
+    H: int, W: int, stride: int, dtype: torch.dtype, device: torch.device
+) -> torch.Tensor:
+    """
+    Location co-ordinates `(H * W, 2)` of a single FPN level. Feature shapes
+    are fixed for a given input size, so these are memoized by (shape,
+    stride, dtype, device), in a bounded cache.
+    """
+    # Locations are flattened row-major: `(H, W) -> (H * W)`, same as
+    # predictions. Rows give `yc` and columns give `xc`.
+    yc, xc = torch.meshgrid(
+        torch.arange(H, device=device, dtype=dtype),
+        torch.arange(W, device=device, dtype=dtype),
+        indexing="ij",
+    )
+
+    xc = xc * stride + stride * 0.5
+    yc = yc * stride + stride * 0.5
+
+    return torch.stack([xc, yc], dim=-1).view(-1, 2)
+
+
+class FPNLocations(NamedTuple):
+    """
+    Locations of all FPN levels concatenated (in order of levels), with
+    per-location attributes of their level. `N` is the total number of
+    locations across levels.
+    """
+
+    locations: torch.Tensor  # `(N, 2)` giving `(xc, yc)` co-ordinates.
+    strides: torch.Tensor  # `(N, )` stride of FPN level of every location.
+    lower_bounds: torch.Tensor  # `(N, )` scale range of every location,
+    upper_bounds: torch.Tensor  # used to match GT boxes (see matching).
+    num_locations_per_level: Tuple[int, ...]
+
+
+def get_fpn_all_level_locations(
+    shape_per_fpn_level: Dict[str, Tuple],
+    strides_per_fpn_level: Dict[str, int],
+    dtype: torch.dtype = torch.float32,
+    device: str = "cpu",
+) -> FPNLocations:
+    """
+    Same as `get_fpn_location_coords`, but locations of all FPN levels are
+    concatenated, along with per-location stride and the range of GT box
+    sizes (max LTRB distance) that a location is responsible for. These are
+    memoized like location grids, DO NOT modify them in-place.
+    """
+    # Hashable key: `(level_name, H, W, stride)` per level.
+    level_key = tuple(
+        (level_name, shape[2], shape[3], strides_per_fpn_level[level_name])
+        for level_name, shape in shape_per_fpn_level.items()
+    )
+    return _get_all_level_locations(level_key, dtype, torch.device(device))
+
+
+@functools.lru_cache(maxsize=8)
+def _get_all_level_locations(
+    level_key: Tuple[Tuple[str, int, int, int], ...],
+    dtype: torch.dtype,
+    device: torch.device,
+) -> FPNLocations:
+    locations, strides, lower_bounds, upper_bounds = [], [], [], []
+    for level_name, H, W, stride in level_key:
+        level_locations = _get_location_grid(H, W, stride, dtype, device)
+        num_locations = level_locations.shape[0]
+
+        # Multilevel anchor matching in FCOS: each anchor is only responsible
+        # for certain scale range (same as `fcos_match_locations_to_gt`).
+        lower_bound = stride * 4 if level_name != "p3" else 0
+        upper_bound = stride * 8 if level_name != "p5" else float("inf")
+
+        locations.append(level_locations)
+        strides.append(level_locations.new_full((num_locations,), stride))
+        lower_bounds.append(level_locations.new_full((num_locations,), lower_bound))
+        upper_bounds.append(level_locations.new_full((num_locations,), upper_bound))
+
+    return FPNLocations(
+        locations=torch.cat(locations),
+        strides=torch.cat(strides),
+        lower_bounds=torch.cat(lower_bounds),
+        upper_bounds=torch.cat(upper_bounds),
+        num_locations_per_level=tuple(H * W for _, H, W, _ in level_key),
+    )
+
+
+NMS_BACKENDS = ("bitmask", "torchvision", "reference")
+
+# Number of boxes suppressed together by the "bitmask" NMS backend. IoU is
+# computed for at most `(tile, tile)` and `(kept, N)` pairs at once.
+_NMS_TILE_SIZE = 256
+
+
+def nms(
+    boxes: torch.Tensor,
+    scores: torch.Tensor,
+    iou_threshold: float = 0.5,
+    backend: str = "bitmask",
+):
     """
     Non-maximum suppression removes overlapping bounding boxes.
     Args:
@@ -222,6 +325,10 @@ def nms(boxes: torch.Tensor, scores: torch.Tensor, iou_threshold: float = 0.5):
             of the bounding boxes to perform NMS on.
         scores: Tensor of shpe (N, ) giving scores for each of the boxes.
         iou_threshold: Discard all overlapping boxes with IoU > iou_threshold
+        backend: One of `NMS_BACKENDS`. All of them give the same result:
+            "bitmask" (default) suppresses boxes in tiles without iterating
+            over boxes in Python, "torchvision" calls `torchvision.ops.nms`,
+            and "reference" is a per-box loop, to verify the others.
     Returns:
         keep: torch.long tensor with the indices of the elements that have been
             kept by NMS, sorted in decreasing order of scores;
@@ -229,7 +336,7 @@ def nms(boxes: torch.Tensor, scores: torch.Tensor, iou_threshold: float = 0.5):
     """
 
     if (not boxes.numel()) or (not scores.numel()):
-        return torch.zeros(0, dtype=torch.long)
+        return torch.zeros(0, dtype=torch.long, device=boxes.device)
 
     keep = None
     #############################################################################
@@ -244,51 +351,143 @@ def nms(boxes: torch.Tensor, scores: torch.Tensor, iou_threshold: float = 0.5):
     # github.com/pytorch/vision/blob/main/torchvision/csrc/ops/cpu/nms_kernel.cpp
     #############################################################################
     # Replace "PASS" statement with your code
-    keep = []
-    values, indices = torch.sort(scores, descending=True)
-    
-    x1, y1 = boxes[:, 0], boxes[:, 3] # top-left coord
-    x2, y2 = boxes[:, 2], boxes[:, 1] # bot-right coord
-    
-    bounding_box_area = (x2 - x1) * (y2 - y1)
-    
-    
-    while torch.numel(indices) > 0:    
-        curr_highest = indices[0]
-        keep.append(curr_highest)
-    
-        xx1 = torch.max(x1[curr_highest], x1[indices[1:]])
-        yy1 = torch.min(y1[curr_highest], y1[indices[1:]])
-        xx2 = torch.min(x2[curr_highest], x2[indices[1:]])
-        yy2 = torch.max(y2[curr_highest], y2[indices[1:]])
-
-        # ensure w & h non-negative
-        w = torch.abs(xx2-xx1)
-        h = torch.abs(yy2 - yy1)
-        
-        # iou = (Target ∩ Prediction) / (Target U Prediction)
-        intersection = w * h
-        union = bounding_box_area[curr_highest] + \
-            bounding_box_area[indices[1:]] - intersection
-        iou = intersection / union
-        indices = indices[1:][iou <= iou_threshold]
-
-    keep = torch.tensor(keep, device=boxes.device, dtype=torch.long)
+    if backend == "bitmask":
+        keep = _nms_bitmask(boxes, scores, iou_threshold)
+    elif backend == "torchvision":
+        keep = torchvision.ops.nms(boxes, scores, iou_threshold)
+    elif backend == "reference":
+        keep = _nms_reference(boxes, scores, iou_threshold)
+    else:
+        raise ValueError(
+            f"Unknown NMS backend {backend!r}, expected one of {NMS_BACKENDS}"
+        )
     #############################################################################
     #                              END OF YOUR CODE                             #
     #############################################################################
     return keep
 
 
+def _box_iou(boxes1: torch.Tensor, boxes2: torch.Tensor) -> torch.Tensor:
+    """
+    Pairwise IoU `(N, M)` between boxes `(N, 4)` and `(M, 4)` in XYXY format.
+    Boxes that do not overlap have zero intersection (and IoU).
+    """
+    area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+
+    top_left = torch.max(boxes1[:, None, :2], boxes2[None, :, :2])
+    bottom_right = torch.min(boxes1[:, None, 2:], boxes2[None, :, 2:])
+    wh = (bottom_right - top_left).clamp(min=0)
+    intersection = wh[..., 0] * wh[..., 1]
+
+    union = area1[:, None] + area2[None, :] - intersection
+    return intersection / union
+
+
+def _nms_reference(
+    boxes: torch.Tensor,
+    scores: torch.Tensor,
+    iou_threshold: float,
+    group_ids: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    """
+    Greedy NMS, one kept box per iteration. Slow, used to verify the other
+    backends. If `group_ids` are given, boxes only suppress boxes of their
+    own group.
+    """
+    keep = []
+    indices = torch.sort(scores, descending=True)[1]
+
+    while indices.numel() > 0:
+        curr_highest = indices[0]
+        keep.append(curr_highest)
+
+        iou = _box_iou(boxes[curr_highest][None], boxes[indices[1:]])[0]
+        # Not `iou <= iou_threshold`: IoU of zero-area boxes is NaN, and
+        # they must not be suppressed (same as other backends).
+        suppressed = iou > iou_threshold
+        if group_ids is not None:
+            suppressed &= group_ids[indices[1:]] == group_ids[curr_highest]
+        indices = indices[1:][~suppressed]
+
+    return torch.stack(keep)
+
+
+def _nms_bitmask(
+    boxes: torch.Tensor,
+    scores: torch.Tensor,
+    iou_threshold: float,
+    group_ids: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    """
+    Greedy NMS over boxes sorted by score, in tiles of `_NMS_TILE_SIZE`.
+
+    Within a tile, a `(tile, tile)` IoU mask gives which (higher-scoring) box
+    suppresses which. Kept boxes of the tile are resolved by fixed point
+    iteration: a box is kept if it is not removed by earlier tiles, and not
+    suppressed by any kept box before it. This system is triangular, so its
+    fixed point is unique (and equal to greedy NMS); it is reached in one
+    iteration per chain of suppressions, usually a few. Kept boxes of the tile
+    then remove all later boxes they overlap, in one vectorized step.
+    If `group_ids` are given, IoU masks are restricted to pairs of boxes in
+    the same group, so groups are kept apart exactly.
+    """
+    order = torch.sort(scores, descending=True)[1]
+    boxes = boxes[order]
+    num_boxes = boxes.shape[0]
+    if group_ids is not None:
+        group_ids = group_ids[order]
+
+    removed = torch.zeros(num_boxes, dtype=torch.bool, device=boxes.device)
+
+    for start in range(0, num_boxes, _NMS_TILE_SIZE):
+        end = min(start + _NMS_TILE_SIZE, num_boxes)
+        alive = ~removed[start:end]
+        if not alive.any():
+            continue
+
+        tile_boxes = boxes[start:end]
+        # `suppresses[i, j]`: box `i` suppresses a lower scoring box `j`.
+        suppresses = (_box_iou(tile_boxes, tile_boxes) > iou_threshold).triu_(1)
+        if group_ids is not None:
+            tile_groups = group_ids[start:end]
+            suppresses &= tile_groups[:, None] == tile_groups[None, :]
+
+        tile_keep = alive
+        while True:
+            suppressed = (suppresses & tile_keep[:, None]).any(dim=0)
+            new_keep = alive & ~suppressed
+            if torch.equal(new_keep, tile_keep):
+                break
+            tile_keep = new_keep
+        removed[start:end] = ~tile_keep
+
+        if end < num_boxes:
+            later = (~removed[end:]).nonzero().squeeze(1) + end
+            if later.numel() > 0:
+                overlaps = _box_iou(tile_boxes[tile_keep], boxes[later]) > iou_threshold
+                if group_ids is not None:
+                    overlaps &= (
+                        tile_groups[tile_keep][:, None] == group_ids[later][None, :]
+                    )
+                removed[later[overlaps.any(dim=0)]] = True
+
+    return order[~removed]
+
+
 def class_spec_nms(
     boxes: torch.Tensor,
     scores: torch.Tensor,
     class_ids: torch.Tensor,
     iou_threshold: float = 0.5,
+    backend: str = "bitmask",
 ):
     """
     Wrap `nms` to make it class-specific. Pass class IDs as `class_ids`.
     STUDENT: This depends on your `nms` implementation.
+    `backend` selects the `nms` backend, see `NMS_BACKENDS`. Classes are kept
+    apart exactly, for any number of class IDs (e.g. IDs that also encode
+    images of a batch, see `FCOS.inference`).
     Returns:
         keep: torch.long tensor with the indices of the elements that have been
             kept by NMS, sorted in decreasing order of scores;
@@ -296,11 +495,21 @@ def class_spec_nms(
     """
     if boxes.numel() == 0:
         return torch.empty((0,), dtype=torch.int64, device=boxes.device)
-    max_coordinate = boxes.max()
-    offsets = class_ids.to(boxes) * (max_coordinate + torch.tensor(1).to(boxes))
-    boxes_for_nms = boxes + offsets[:, None]
-    keep = nms(boxes_for_nms, scores, iou_threshold)
-    return keep
+    if backend == "bitmask":
+        return _nms_bitmask(boxes, scores, iou_threshold, group_ids=class_ids)
+    if backend == "reference":
+        return _nms_reference(boxes, scores, iou_threshold, group_ids=class_ids)
+    if backend == "torchvision":
+        # Offset boxes of each class apart. Offsets grow with class IDs, so
+        # use float64 to not lose precision (or overflow) of co-ordinates.
+        boxes = boxes.double()
+        offsets = class_ids.double() * (boxes.max() + 1)
+        return torchvision.ops.nms(
+            boxes + offsets[:, None], scores.double(), iou_threshold
+        )
+    raise ValueError(
+        f"Unknown NMS backend {backend!r}, expected one of {NMS_BACKENDS}"
+    )
 
 
 # Short hand type notation:
@@ -321,7 +530,11 @@ class FCOSPredictionNetwork(nn.Module):
     """
 
     def __init__(
-        self, num_classes: int, in_channels: int, stem_channels: List[int]
+        self,
+        num_classes: int,
+        in_channels: int,
+        stem_channels: List[int],
+        pack_levels: bool = False,
     ):
         """
         Args:
@@ -331,8 +544,12 @@ class FCOSPredictionNetwork(nn.Module):
                 operates on them.
             stem_channels: List of integers giving the number of output channels
                 in each convolution layer of stem layers.
+            pack_levels: Whether to run all FPN levels through the (shared)
+                layers as a single feature map, instead of one level at a
+                time. See `_predict_packed`.
         """
         super().__init__()
+        self.pack_levels = pack_levels
 
         ######################################################################
         # TODO: Create a stem of alternating 3x3 convolution layers and RELU
@@ -352,41 +569,22 @@ class FCOSPredictionNetwork(nn.Module):
         
         stem_cls = []
         stem_box = []
-        stem_cls.append(nn.Conv2d(in_channels, stem_channels[0], kernel_size=3, stride=1, padding=1))
-        stem_cls.append(nn.ReLU())
-        stem_box.append(nn.Conv2d(in_channels, stem_channels[0], kernel_size=3, stride=1, padding=1))
-        stem_box.append(nn.ReLU())
-        nn.init.normal_(stem_cls[0].weight.data, mean=0.0, std=.01).cuda()
-        stem_cls[0].weight.data = stem_cls[0].weight.data.cuda()
-        
-        nn.init.normal_(stem_box[0].weight.data, mean=0.0, std=.01).cuda()
-        stem_box[0].weight.data = stem_box[0].weight.data.cuda()
-        nn.init.constant_(stem_cls[0].bias.data, 0).cuda()
-        stem_cls[0].bias.data = stem_cls[0].bias.data.cuda()
-        
-        nn.init.constant_(stem_box[0].bias.data, 0).cuda()
-        stem_box[0].bias.data = stem_box[0].bias.data.cuda()
-        
-        for i in range(1, len(stem_channels)):
-            stem_cls.append(nn.Conv2d(stem_channels[i-1], stem_channels[i], kernel_size=3, stride=1, padding=1))
-            stem_cls.append(nn.ReLU())
-            
-            stem_box.append(nn.Conv2d(stem_channels[i-1], stem_channels[i], kernel_size=3, stride=1, padding=1))
-            stem_box.append(nn.ReLU())
-            
-            torch.nn.init.normal_(stem_cls[i*2].weight.data, mean=0.0, std=.01).cuda()
-            stem_cls[i*2].weight.data = stem_cls[i*2].weight.data.cuda()
-            torch.nn.init.normal_(stem_box[i*2].weight.data, mean=0.0, std=.01).cuda()
-            stem_box[i*2].weight.data = stem_box[i*2].weight.data.cuda()
-            
-            nn.init.constant_(stem_cls[i*2].bias.data, 0).cuda()
-            stem_cls[i*2].bias.data = stem_cls[i*2].bias.data.cuda()
-            
-            nn.init.constant_(stem_box[i*2].bias.data, 0).cuda()
-            stem_box[i*2].bias.data = stem_box[i*2].bias.data.cuda()
-        
-        self.stem_cls = stem_cls
-        self.stem_box = stem_box
+        for i in range(len(stem_channels)):
+            stem_in_channels = in_channels if i == 0 else stem_channels[i - 1]
+            for stem in (stem_cls, stem_box):
+                conv = nn.Conv2d(
+                    stem_in_channels, stem_channels[i],
+                    kernel_size=3, stride=1, padding=1,
+                )
+                nn.init.normal_(conv.weight, mean=0.0, std=0.01)
+                nn.init.constant_(conv.bias, 0)
+                stem.append(conv)
+                stem.append(nn.ReLU())
+
+        # Wrap stems in `nn.Sequential` so that their parameters are
+        # registered: they are moved along with the model by `.to(device)`.
+        self.stem_cls = nn.Sequential(*stem_cls)
+        self.stem_box = nn.Sequential(*stem_box)
 
         ######################################################################
         # TODO: Create THREE 3x3 conv layers for individually predicting three
@@ -410,9 +608,9 @@ class FCOSPredictionNetwork(nn.Module):
         self.pred_ctr = None  # Centerness conv
 
         # Replace "PASS" statement with your code
-        self.pred_cls = nn.Conv2d(in_channels, num_classes, kernel_size=3, stride=1, padding=1)
-        self.pred_box = nn.Conv2d(in_channels, 4, kernel_size=3, stride=1, padding=1)
-        self.pred_ctr = nn.Conv2d(in_channels, 1, kernel_size=3, stride=1, padding=1)
+        self.pred_cls = nn.Conv2d(stem_channels[-1], num_classes, kernel_size=3, stride=1, padding=1)
+        self.pred_box = nn.Conv2d(stem_channels[-1], 4, kernel_size=3, stride=1, padding=1)
+        self.pred_ctr = nn.Conv2d(stem_channels[-1], 1, kernel_size=3, stride=1, padding=1)
 
         ######################################################################
         #                           END OF YOUR CODE                         #
@@ -458,36 +656,16 @@ class FCOSPredictionNetwork(nn.Module):
         centerness_logits = {}
 
         # Replace "PASS" statement with your code
-        for level in feats_per_fpn_level.keys():
-            count = 0
-            
-            class_logit = self.stem_cls[count*2](feats_per_fpn_level[level].cuda())
-            
-            boxreg_delta = self.stem_box[(count*2)+1](feats_per_fpn_level[level].cuda())
-
-            centerness_logit = self.stem_box[count*2](feats_per_fpn_level[level].cuda())
-            
-            count += 1
-            
-            self.stem_cls[count*2].weight.data = self.stem_cls[count*2].weight.data.cuda()
-            self.pred_cls.weight.data = self.pred_cls.weight.data.cuda()
-            self.pred_cls.bias.data = self.pred_cls.bias.data.cuda()
-            class_logit = self.pred_cls(self.stem_cls[count*2](class_logit))
-            batch_size, num_classes, H, W = class_logit.shape
-            class_logit = class_logit.swapaxes(1,2).swapaxes(2,3).reshape(batch_size, H*W, num_classes)
-            
-            boxreg_delta = self.pred_box(self.stem_box[(count*2)+1](feats_per_fpn_level[level]))
-            batch_size, C, H, W = boxreg_delta.shape
-            boxreg_delta = boxreg_delta.swapaxes(1,2).swapaxes(2,3).reshape(batch_size, H*W, C)
-            
-            self.pred_ctr = self.pred_ctr.cuda()
-            self.stem_box[count*2] = self.stem_box[count*2].cuda()
-            self.pred_ctr.weight.data = self.pred_ctr.weight.data.cuda()
-            self.pred_ctr.bias.data = self.pred_ctr.bias.data.cuda()
-            centerness_logit = self.pred_ctr(self.stem_box[count*2](feats_per_fpn_level[level].cuda()))
-            batch_size, C, H, W  = centerness_logit.shape
-            centerness_logit = centerness_logit.swapaxes(1, 2).swapaxes(2,3).reshape(batch_size, H*W, C)
-            
+        if self.pack_levels:
+            outputs_per_fpn_level = self._predict_packed(feats_per_fpn_level)
+        else:
+            outputs_per_fpn_level = self._predict_levels(feats_per_fpn_level)
+
+        for level, outputs in outputs_per_fpn_level.items():
+            # (batch_size, C, H, W) -> (batch_size, H * W, C)
+            class_logit, boxreg_delta, centerness_logit = [
+                output.flatten(start_dim=2).transpose(1, 2) for output in outputs
+            ]
             class_logits[level] = class_logit
             boxreg_deltas[level] = boxreg_delta
             centerness_logits[level] = centerness_logit
@@ -497,6 +675,64 @@ class FCOSPredictionNetwork(nn.Module):
 
         return [class_logits, boxreg_deltas, centerness_logits]
 
+    def _predict_heads(self, cls_feats, box_feats):
+        # Box regression and centerness share the output of `stem_box`.
+        return (
+            self.pred_cls(cls_feats),
+            self.pred_box(box_feats),
+            self.pred_ctr(box_feats),
+        )
+
+    def _predict_levels(self, feats_per_fpn_level: TensorDict):
+        """
+        Run stems and prediction layers on every FPN level separately. Returns
+        a dict of `(class_logits, boxreg_deltas, centerness_logits)` per level,
+        with shapes `(batch_size, C, H, W)`.
+        """
+        return {
+            level: self._predict_heads(self.stem_cls(feats), self.stem_box(feats))
+            for level, feats in feats_per_fpn_level.items()
+        }
+
+    def _predict_packed(self, feats_per_fpn_level: TensorDict):
+        """
+        Same as `_predict_levels`, but all FPN levels are placed side by side
+        on one feature map, so every layer runs once for all levels. Levels
+        are separated by a column of zeros, and zeros fill the rows below
+        smaller levels. This region is zeroed again after every stem conv,
+        so the 3x3 convs see exactly the zero padding of each separate level.
+        """
+        feats = list(feats_per_fpn_level.values())
+        batch_size, channels = feats[0].shape[:2]
+        height = max(f.shape[2] for f in feats)
+        width = sum(f.shape[3] for f in feats) + len(feats) - 1
+
+        packed = feats[0].new_zeros(batch_size, channels, height, width)
+        mask = feats[0].new_zeros(1, 1, height, width)
+        regions = []
+        x1 = 0
+        for f in feats:
+            x2 = x1 + f.shape[3]
+            packed[:, :, : f.shape[2], x1:x2] = f
+            mask[:, :, : f.shape[2], x1:x2] = 1
+            regions.append((f.shape[2], x1, x2))
+            x1 = x2 + 1
+
+        def run_stem(stem, x):
+            for layer in stem:
+                x = layer(x)
+                if isinstance(layer, nn.Conv2d):
+                    x = x * mask
+            return x
+
+        outputs = self._predict_heads(
+            run_stem(self.stem_cls, packed), run_stem(self.stem_box, packed)
+        )
+        return {
+            level: [output[:, :, :h, x1:x2] for output in outputs]
+            for level, (h, x1, x2) in zip(feats_per_fpn_level.keys(), regions)
+        }
+
 
 @torch.no_grad()
 def fcos_match_locations_to_gt(
@@ -540,15 +776,16 @@ def fcos_match_locations_to_gt(
         # Get stride for this FPN level.
         stride = strides_per_fpn_level[level_name]
 
+        # Images without any GT box (possible with ragged GT boxes): every
+        # location is background.
+        if gt_boxes.shape[0] == 0:
+            matched_gt_boxes[level_name] = gt_boxes.new_full(
+                (centers.shape[0], gt_boxes.shape[1]), -1
+            )
+            continue
+
         x, y = centers.unsqueeze(dim=2).unbind(dim=1)
-        x = x.cuda()
-        y = y.cuda()
-        gt_boxes[:,:4] = gt_boxes[:,:4].cuda()
         x0, y0, x1, y1 = gt_boxes[:, :4].unsqueeze(dim=0).unbind(dim=2)
-        x0 = x0.cuda()
-        y0 = y0.cuda()
-        x1 = x1.cuda()
-        y1 = y1.cuda()
         pairwise_dist = torch.stack([x - x0, y - y0, x1 - x, y1 - y], dim=2)
 
         # Pairwise distance between every feature center and GT box edges:
@@ -575,15 +812,14 @@ def fcos_match_locations_to_gt(
         )
 
         # Get matches and their labels using match quality matrix.
-        match_matrix = match_matrix.to(torch.float32).cuda()
-        match_matrix *= 1e8 - gt_areas[:, None].cuda()
+        match_matrix = match_matrix.to(torch.float32)
+        match_matrix *= 1e8 - gt_areas[:, None]
 
         # Find matched ground-truth instance per anchor (un-matched = -1).
         match_quality, matched_idxs = match_matrix.max(dim=0)
         matched_idxs[match_quality < 1e-5] = -1
 
         # Anchors with label 0 are treated as background.
-        gt_boxes = gt_boxes.cuda()
         matched_boxes_this_level = gt_boxes[matched_idxs.clip(min=0)]
         matched_boxes_this_level[matched_idxs < 0, :] = -1
 
@@ -592,6 +828,218 @@ def fcos_match_locations_to_gt(
     return matched_gt_boxes
 
 
+@torch.no_grad()
+def fcos_match_locations_to_gt_batched(
+    fpn_locations: FPNLocations, gt_boxes: torch.Tensor
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Batched version of `fcos_match_locations_to_gt`, that also computes the
+    training targets: all images in batch and all FPN levels are matched in
+    one set of tensor ops. Matching rules are the same, the scale range of
+    every location is given by `fpn_locations` instead of level names.
+    Args:
+        fpn_locations: Locations of all FPN levels, from
+            `get_fpn_all_level_locations`. `N` locations in total.
+        gt_boxes: GT boxes of a batch of images `(B, M, 5)`, padded with -1.
+    Returns:
+        Three tensors:
+            - matched_gt_boxes: `(B, N, 5)` GT box per location, or -1 for
+              background (same as `fcos_match_locations_to_gt`).
+            - matched_gt_deltas: `(B, N, 4)` deltas of these boxes from the
+              locations (same as `fcos_get_deltas_from_locations`).
+            - matched_gt_centerness: `(B, N)` centerness targets (same as
+              `fcos_make_centerness_targets`).
+    """
+    locations, strides = fpn_locations.locations, fpn_locations.strides
+    batch_size, num_locations = gt_boxes.shape[0], locations.shape[0]
+
+    if gt_boxes.shape[1] == 0:
+        matched_gt_boxes = gt_boxes.new_full((batch_size, num_locations, 5), -1)
+    else:
+        # Distances between every location and GT box edges, shape of each
+        # is `(B, N, M)`: locations along dim 1 and GT boxes along dim 2.
+        x = locations[None, :, 0, None]
+        y = locations[None, :, 1, None]
+        x0, y0, x1, y1 = gt_boxes[:, None, :, :4].unbind(dim=3)
+        left, top, right, bottom = x - x0, y - y0, x1 - x, y1 - y
+
+        # The original FCOS anchor matching rule: anchor point must be inside GT.
+        min_dist = torch.minimum(
+            torch.minimum(left, top), torch.minimum(right, bottom)
+        )
+        match_matrix = min_dist > 0
+
+        # Multilevel anchor matching in FCOS: each anchor is only responsible
+        # for certain scale range.
+        max_dist = torch.maximum(
+            torch.maximum(left, top), torch.maximum(right, bottom)
+        )
+        lower_bounds = fpn_locations.lower_bounds[None, :, None]
+        upper_bounds = fpn_locations.upper_bounds[None, :, None]
+        match_matrix &= (max_dist > lower_bounds) & (max_dist < upper_bounds)
+
+        # Match the GT box with minimum area, if there are multiple GT matches.
+        gt_areas = (gt_boxes[:, :, 2] - gt_boxes[:, :, 0]) * (
+            gt_boxes[:, :, 3] - gt_boxes[:, :, 1]
+        )
+        match_matrix = match_matrix.to(torch.float32)
+        match_matrix *= 1e8 - gt_areas[:, None, :]
+
+        # Find matched ground-truth instance per anchor (un-matched = -1).
+        match_quality, matched_idxs = match_matrix.max(dim=2)
+        matched_idxs[match_quality < 1e-5] = -1
+
+        matched_gt_boxes = torch.gather(
+            gt_boxes, 1, matched_idxs.clip(min=0)[:, :, None].expand(-1, -1, 5)
+        )
+        matched_gt_boxes[matched_idxs < 0] = -1
+
+    return (matched_gt_boxes,) + fcos_make_targets_from_matched_boxes(
+        fpn_locations, matched_gt_boxes
+    )
+
+
+@torch.no_grad()
+def fcos_make_targets_from_matched_boxes(
+    fpn_locations: FPNLocations, matched_gt_boxes: torch.Tensor
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Compute `(B, N, 4)` deltas and `(B, N)` centerness targets for `(B, N, 5)`
+    GT boxes matched to all `N` FPN locations (-1 for background), see
+    `fcos_match_locations_to_gt_batched`.
+    """
+    locations, strides = fpn_locations.locations, fpn_locations.strides
+    batch_size, num_locations = matched_gt_boxes.shape[:2]
+
+    # LTRB deltas normalized by stride of every location.
+    matched_gt_deltas = torch.cat(
+        [
+            locations[None] - matched_gt_boxes[:, :, :2],
+            matched_gt_boxes[:, :, 2:4] - locations[None],
+        ],
+        dim=2,
+    )
+    matched_gt_deltas /= strides[None, :, None]
+    background = matched_gt_boxes[:, :, 4] == -1
+    matched_gt_deltas[background] = -1
+
+    matched_gt_centerness = fcos_make_centerness_targets(
+        matched_gt_deltas.view(-1, 4)
+    ).view(batch_size, num_locations)
+    return matched_gt_deltas, matched_gt_centerness
+
+
+@torch.no_grad()
+def fcos_match_locations_to_gt_sparse(
+    shape_per_fpn_level: Dict[str, Tuple],
+    strides_per_fpn_level: Dict[str, int],
+    gt_boxes: torch.Tensor,
+) -> TensorDict:
+    """
+    Sparse version of `fcos_match_locations_to_gt`, with identical results.
+    Instead of distances between ALL locations and ALL GT boxes, it only
+    considers the feature grid cells within the extent of each GT box, that
+    are enumerated by index arithmetic on the regular location grid. Memory
+    and time are proportional to the number of covered cells, which matters
+    for crowded images or large inputs.
+    NOTE: Ties (GT boxes with equal areas) are resolved by the smaller GT box
+    index, like `torch.max` does for the dense version on CPU.
+    Args:
+        shape_per_fpn_level: Shape of the FPN feature level, dictionary of keys
+            {"p3", "p4", "p5"} and feature shapes `(B, C, H, W)` as values.
+        strides_per_fpn_level: Dictionary of same keys as above, each with an
+            integer value giving the stride of corresponding FPN level.
+        gt_boxes: GT boxes of a single image, a batch of `(M, 5)` boxes.
+    Returns:
+        Dict[str, torch.Tensor]
+            Same as `fcos_match_locations_to_gt`.
+    """
+    matched_gt_boxes = {}
+    num_gt = gt_boxes.shape[0]
+    x0, y0, x1, y1 = gt_boxes[:, :4].unbind(dim=1)
+    gt_areas = (gt_boxes[:, 2] - gt_boxes[:, 0]) * (
+        gt_boxes[:, 3] - gt_boxes[:, 1]
+    )
+    gt_quality = 1e8 - gt_areas
+
+    for level_name, feat_shape in shape_per_fpn_level.items():
+        stride = strides_per_fpn_level[level_name]
+        H, W = feat_shape[2], feat_shape[3]
+        if num_gt == 0:
+            matched_gt_boxes[level_name] = gt_boxes.new_full((H * W, 5), -1)
+            continue
+
+        centers = _get_location_grid(
+            H, W, stride, gt_boxes.dtype, gt_boxes.device
+        )
+
+        # Range of columns `[j_lo, j_hi)` and rows `[i_lo, i_hi)` whose centers
+        # `(j + 0.5) * stride` may be inside each box. It is widened by a cell
+        # on both sides; the exact test (same as dense version) is done below.
+        j_lo = torch.floor(x0 / stride - 0.5).clamp(0, W).long()
+        j_hi = (torch.ceil(x1 / stride - 0.5) + 1).clamp(0, W).long()
+        i_lo = torch.floor(y0 / stride - 0.5).clamp(0, H).long()
+        i_hi = (torch.ceil(y1 / stride - 0.5) + 1).clamp(0, H).long()
+        num_cols = (j_hi - j_lo).clamp(min=0)
+        num_cells = num_cols * (i_hi - i_lo).clamp(min=0)
+
+        # Enumerate (GT box, cell) pairs: cell `k` of box `m` is at row
+        # `i_lo + k // num_cols` and column `j_lo + k % num_cols`.
+        pair_gt = torch.repeat_interleave(
+            torch.arange(num_gt, device=gt_boxes.device), num_cells
+        )
+        first_pair = torch.cumsum(num_cells, dim=0) - num_cells
+        pair_cell = torch.arange(len(pair_gt), device=gt_boxes.device)
+        pair_cell = pair_cell - first_pair[pair_gt]
+        pair_row = i_lo[pair_gt] + pair_cell // num_cols[pair_gt]
+        pair_col = j_lo[pair_gt] + pair_cell % num_cols[pair_gt]
+        pair_location = pair_row * W + pair_col
+
+        # Same matching rules (and float ops) as the dense version.
+        x, y = centers[pair_location].unbind(dim=1)
+        pairwise_dist = torch.stack(
+            [x - x0[pair_gt], y - y0[pair_gt], x1[pair_gt] - x, y1[pair_gt] - y],
+            dim=1,
+        )
+        is_match = pairwise_dist.min(dim=1).values > 0
+        pairwise_dist = pairwise_dist.max(dim=1).values
+
+        lower_bound = stride * 4 if level_name != "p3" else 0
+        upper_bound = stride * 8 if level_name != "p5" else float("inf")
+        is_match &= (pairwise_dist > lower_bound) & (pairwise_dist < upper_bound)
+
+        # Dense version marks locations with match quality < 1e-5 unmatched.
+        pair_quality = gt_quality[pair_gt]
+        is_match &= pair_quality >= 1e-5
+        pair_gt, pair_location = pair_gt[is_match], pair_location[is_match]
+        pair_quality = pair_quality[is_match]
+
+        # Match the GT box with minimum area (max quality) per location, ties
+        # go to the smaller GT index.
+        best_quality = torch.full(
+            (H * W,), -float("inf"), dtype=pair_quality.dtype,
+            device=gt_boxes.device,
+        )
+        best_quality.scatter_reduce_(
+            0, pair_location, pair_quality, reduce="amax", include_self=True
+        )
+        is_best = pair_quality == best_quality[pair_location]
+        matched_idxs = torch.full(
+            (H * W,), num_gt, dtype=torch.long, device=gt_boxes.device
+        )
+        matched_idxs.scatter_reduce_(
+            0, pair_location[is_best], pair_gt[is_best],
+            reduce="amin", include_self=True,
+        )
+        matched_idxs[matched_idxs == num_gt] = -1
+
+        matched_boxes_this_level = gt_boxes[matched_idxs.clip(min=0)]
+        matched_boxes_this_level[matched_idxs < 0, :] = -1
+        matched_gt_boxes[level_name] = matched_boxes_this_level
+
+    return matched_gt_boxes
+
+
 def fcos_get_deltas_from_locations(
     locations: torch.Tensor, gt_boxes: torch.Tensor, stride: int
 ) -> torch.Tensor:
@@ -623,8 +1071,6 @@ def fcos_get_deltas_from_locations(
     deltas = None
 
     # Replace "PASS" statement with your code  
-    locations = locations.cuda()
-    gt_boxes = gt_boxes.cuda()
     L = locations[:, 0] - gt_boxes[:, 0]
     T = locations[:, 1] - gt_boxes[:, 1]
     R = gt_boxes[:, 2] - locations[:, 0]   
@@ -658,7 +1104,9 @@ def fcos_apply_deltas_to_locations(
     Args:
         deltas: Tensor of shape `(N, 4)` giving edge deltas to apply to locations.
         locations: Locations to apply deltas on. shape: `(N, 2)`
-        stride: Stride of the FPN feature map.
+        stride: Stride of the FPN feature map, or a tensor of shape `(N, 1)`
+            giving the stride of every location (for locations of multiple
+            FPN levels).
     Returns:
         torch.Tensor
             Same shape as deltas and locations, giving co-ordinates of the
@@ -733,6 +1181,75 @@ def fcos_make_centerness_targets(deltas: torch.Tensor):
     return centerness
 
 
+class DetectionCandidates(NamedTuple):
+    """
+    Decoded predictions of a batch of images before NMS, flattened across
+    images. `N` is the total number of candidates.
+    """
+
+    image_ids: torch.Tensor  # `(N, )` index of image in the batch.
+    boxes: torch.Tensor  # `(N, 4)` giving absolute XYXY co-ordinates.
+    classes: torch.Tensor  # `(N, )`
+    scores: torch.Tensor  # `(N, )`
+
+
+def fcos_postprocess_candidates(
+    candidates: DetectionCandidates,
+    num_images: int,
+    num_classes: int,
+    score_thresh: Optional[float] = None,
+    nms_thresh: float = 0.5,
+    max_detections: Optional[int] = None,
+) -> List[Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]:
+    """
+    Final predictions of every image from `DetectionCandidates`: discard
+    candidates with score not above `score_thresh` (if given), run NMS once
+    for all images, with boxes grouped by (image, class), and keep at most
+    `max_detections` per image. Used by `FCOS.inference`, and to replay
+    inference on cached candidates with different thresholds.
+    Returns:
+        List with a tuple of `(pred_boxes, pred_classes, pred_scores)` per
+        image, see `FCOS.inference`.
+    """
+    image_ids, boxes, classes, scores = candidates
+    if score_thresh is not None:
+        retain = scores > score_thresh
+        image_ids, boxes = image_ids[retain], boxes[retain]
+        classes, scores = classes[retain], scores[retain]
+
+    # STUDENTS: This function depends on your implementation of NMS.
+    # NMS is class-specific within every image: group boxes by both.
+    keep = class_spec_nms(
+        boxes, scores, image_ids * num_classes + classes, iou_threshold=nms_thresh
+    )
+    boxes, classes, scores = boxes[keep], classes[keep], scores[keep]
+    image_ids = image_ids[keep]
+
+    # Group kept predictions by image, in decreasing order of scores
+    # within each image (stable sort keeps the NMS order), and keep at
+    # most `max_detections` per image.
+    order = torch.sort(image_ids, stable=True)[1]
+    image_ids = image_ids[order]
+    counts = torch.bincount(image_ids, minlength=num_images)
+    if max_detections is not None:
+        image_starts = counts.cumsum(dim=0) - counts
+        rank_in_image = (
+            torch.arange(order.shape[0], device=order.device)
+            - image_starts[image_ids]
+        )
+        order = order[rank_in_image < max_detections]
+        counts = counts.clamp(max=max_detections)
+
+    counts = counts.tolist()
+    return list(
+        zip(
+            boxes[order].split(counts),
+            classes[order].split(counts),
+            scores[order].split(counts),
+        )
+    )
+
+
 class FCOS(nn.Module):
     """
     FCOS: Fully-Convolutional One-Stage Detector
@@ -742,10 +1259,35 @@ class FCOS(nn.Module):
     """
 
     def __init__(
-        self, num_classes: int, fpn_channels: int, stem_channels: List[int]
+        self,
+        num_classes: int,
+        fpn_channels: int,
+        stem_channels: List[int],
+        pack_levels: bool = False,
+        sparse_matching: bool = False,
+        test_pre_nms_topk: Optional[int] = 1000,
+        test_max_detections: Optional[int] = 100,
     ):
+        """
+        Args:
+            pack_levels: Whether the prediction network runs all FPN levels
+                as one feature map, see `FCOSPredictionNetwork`.
+            sparse_matching: Whether to match GT boxes to locations with
+                `fcos_match_locations_to_gt_sparse` (per image), instead of
+                the dense `fcos_match_locations_to_gt_batched`. Prefer it for
+                crowded images or large input sizes.
+            test_pre_nms_topk: During inference, maximum number of (location,
+                class) candidates per FPN level and image that go to NMS.
+                This bounds NMS cost for low score thresholds. `None` keeps
+                all candidates above the score threshold.
+            test_max_detections: During inference, maximum number of
+                predictions per image after NMS. `None` keeps all.
+        """
         super().__init__()
         self.num_classes = num_classes
+        self.sparse_matching = sparse_matching
+        self.test_pre_nms_topk = test_pre_nms_topk
+        self.test_max_detections = test_max_detections
 
         ######################################################################
         # TODO: Initialize backbone and prediction network using arguments.  #
@@ -755,7 +1297,9 @@ class FCOS(nn.Module):
         self.pred_net = None
         # Replace "PASS" statement with your code
         self.backbone = DetectorBackboneWithFPN(fpn_channels)
-        self.pred_net = FCOSPredictionNetwork(num_classes, fpn_channels, stem_channels)
+        self.pred_net = FCOSPredictionNetwork(
+            num_classes, fpn_channels, stem_channels, pack_levels=pack_levels
+        )
         ######################################################################
         #                           END OF YOUR CODE                         #
         ######################################################################
@@ -770,6 +1314,9 @@ class FCOS(nn.Module):
         gt_boxes: Optional[torch.Tensor] = None,
         test_score_thresh: Optional[float] = None,
         test_nms_thresh: Optional[float] = None,
+        gt_targets: Optional[TensorDict] = None,
+        test_per_image: bool = False,
+        test_return_candidates: bool = False,
     ):
         """
         Args:
@@ -781,10 +1328,22 @@ class FCOS(nn.Module):
                 corner of the box is `(x2, x2)`. These coordinates are
                 real-valued in `[H, W]`. `C` is an integer giving the category
                 label for this bounding box. Not provided during inference.
+                May also be `PackedBoxes` (from `DetectionCollate`), then
+                only the real boxes of every image are matched.
+            gt_targets: Training targets that are already computed (e.g. by
+                `FCOSTargetDataset` in DataLoader workers), a dict with keys
+                {"boxes", "deltas", "centerness"} giving matched GT boxes,
+                deltas and centerness of all locations, shapes `(B, N, 5)`,
+                `(B, N, 4)` and `(B, N)`. If given, matching is skipped.
             test_score_thresh: During inference, discard predictions with a
                 confidence score less than this value. Ignored during training.
             test_nms_thresh: IoU threshold for NMS during inference. Ignored
                 during training.
+            test_per_image: During inference, return a list of predictions
+                per image in the batch (see `inference`). Otherwise, batch
+                size must be 1. Ignored during training.
+            test_return_candidates: During inference, return candidates
+                before NMS (see `inference`). Ignored during training.
         Returns:
             Losses during training and predictions during inference.
         """
@@ -798,11 +1357,11 @@ class FCOS(nn.Module):
         # Feel free to delete this line: (but keep variable names same)
         pred_cls_logits, pred_boxreg_deltas, pred_ctr_logits = None, None, None
         # Replace "PASS" statement with your code
+        # Backbone and prediction head run exactly once per batch.
         backbone_fpn_outputs = self.backbone(images)
-        backbone_fpn_outputs = self.backbone.forward(images)
-        pred_cls_logits = self.pred_net.forward(backbone_fpn_outputs)[0]
-        pred_boxreg_deltas = self.pred_net.forward(backbone_fpn_outputs)[1]
-        pred_ctr_logits = self.pred_net.forward(backbone_fpn_outputs)[2]
+        pred_cls_logits, pred_boxreg_deltas, pred_ctr_logits = self.pred_net(
+            backbone_fpn_outputs
+        )
 
         ######################################################################
         # TODO: Get absolute co-ordinates `(xc, yc)` for every location in
@@ -818,7 +1377,13 @@ class FCOS(nn.Module):
         for key,value in backbone_fpn_outputs.items():
             loc_dict[key] = value.shape
             
-        locations_per_fpn_level = get_fpn_location_coords(loc_dict,self.backbone.fpn_strides)
+        # Locations follow dtype and device of the input images.
+        locations_per_fpn_level = get_fpn_location_coords(
+            loc_dict,
+            self.backbone.fpn_strides,
+            dtype=images.dtype,
+            device=images.device,
+        )
         # shape_per_fpn_level: Dict[str, Tuple],
         # strides_per_fpn_level: Dict[str, int],
         # shape_per_fpn_level: Shape of the FPN feature level, dictionary of keys
@@ -830,60 +1395,74 @@ class FCOS(nn.Module):
         #                           END OF YOUR CODE                         #
         ######################################################################
 
+        # Locations of all FPN levels concatenated, with their stride and
+        # scale range as per-location tensors.
+        fpn_locations = get_fpn_all_level_locations(
+            loc_dict,
+            self.backbone.fpn_strides,
+            dtype=images.dtype,
+            device=images.device,
+        )
+
         if not self.training:
             # During inference, just go to this method and skip rest of the
             # forward pass.
             # fmt: off
             return self.inference(
-                images, locations_per_fpn_level,
+                images, fpn_locations,
                 pred_cls_logits, pred_boxreg_deltas, pred_ctr_logits,
                 test_score_thresh=test_score_thresh,
                 test_nms_thresh=test_nms_thresh,
+                test_per_image=test_per_image,
+                test_return_candidates=test_return_candidates,
             )
             # fmt: on
 
         ######################################################################
-        # TODO: Assign ground-truth boxes to feature locations. We have this
-        # implemented in a `fcos_match_locations_to_gt`. This operation is NOT
-        # batched so call it separately per GT boxes in batch.
+        # Assign ground-truth boxes to feature locations, for the whole batch
+        # at once.
         ######################################################################
-        # List of dictionaries with keys {"p3", "p4", "p5"} giving matched
-        # boxes for locations per FPN level, per image. Fill this list:
-        matched_gt_boxes = []
-        # Replace "PASS" statement with your code
-#         def fcos_match_locations_to_gt(
-#     locations_per_fpn_level: TensorDict,
-#     strides_per_fpn_level: Dict[str, int],
-#     gt_boxes: torch.Tensor,
-# ) -> TensorDict:
-        for i in range(gt_boxes.shape[0]):
-            matched_gt_boxes.append(fcos_match_locations_to_gt(locations_per_fpn_level,self.backbone.fpn_strides,gt_boxes[i,:,:]))
-        # Calculate GT deltas for these matched boxes. Similar structure
-        # as `matched_gt_boxes` above. Fill this list:
-        
-#         def fcos_get_deltas_from_locations(
-#     locations: torch.Tensor, gt_boxes: torch.Tensor, stride: int
-# ) -> torch.Tensor:
-        matched_gt_deltas = []
-        for i in range(len(matched_gt_boxes)):
-          gt_match = {}
-          for j in self.backbone.fpn_strides.keys():
-              gt_match[j] = (fcos_get_deltas_from_locations(locations_per_fpn_level[j],matched_gt_boxes[i][j],self.backbone.fpn_strides[j]))
-          matched_gt_deltas.append(gt_match)
-        ######################################################################
-        #                           END OF YOUR CODE                         #
-        ######################################################################
-
-        # Collate lists of dictionaries, to dictionaries of batched tensors.
-        # These are dictionaries with keys {"p3", "p4", "p5"} and values as
-        # tensors of shape (batch_size, locations_per_fpn_level, 5 or 4)
-        matched_gt_boxes = default_collate(matched_gt_boxes)
-        matched_gt_deltas = default_collate(matched_gt_deltas)
-
         # Combine predictions and GT from across all FPN levels.
         # shape: (batch_size, num_locations_across_fpn_levels, ...)
-        matched_gt_boxes = self._cat_across_fpn_levels(matched_gt_boxes)
-        matched_gt_deltas = self._cat_across_fpn_levels(matched_gt_deltas)
+        if gt_targets is not None:
+            matched_gt_boxes = gt_targets["boxes"].to(images.device)
+            matched_gt_deltas = gt_targets["deltas"].to(images.device)
+            matched_gt_centerness = gt_targets["centerness"].to(images.device)
+            if matched_gt_boxes.shape[1] != fpn_locations.locations.shape[0]:
+                raise ValueError(
+                    f"gt_targets have {matched_gt_boxes.shape[1]} locations, "
+                    f"expected {fpn_locations.locations.shape[0]}."
+                )
+        elif self.sparse_matching:
+            if isinstance(gt_boxes, PackedBoxes):
+                gt_boxes_per_image = gt_boxes.unbind()
+            else:
+                gt_boxes_per_image = [b[b[:, 4] != -1] for b in gt_boxes]
+            matched_gt_boxes = torch.stack(
+                [
+                    self._cat_across_fpn_levels(
+                        fcos_match_locations_to_gt_sparse(
+                            loc_dict, self.backbone.fpn_strides, b
+                        ),
+                        dim=0,
+                    )
+                    for b in gt_boxes_per_image
+                ]
+            )
+            (
+                matched_gt_deltas,
+                matched_gt_centerness,
+            ) = fcos_make_targets_from_matched_boxes(
+                fpn_locations, matched_gt_boxes
+            )
+        else:
+            if isinstance(gt_boxes, PackedBoxes):
+                gt_boxes = gt_boxes.to_padded()
+            (
+                matched_gt_boxes,
+                matched_gt_deltas,
+                matched_gt_centerness,
+            ) = fcos_match_locations_to_gt_batched(fpn_locations, gt_boxes)
         pred_cls_logits = self._cat_across_fpn_levels(pred_cls_logits)
         pred_boxreg_deltas = self._cat_across_fpn_levels(pred_boxreg_deltas)
         pred_ctr_logits = self._cat_across_fpn_levels(pred_ctr_logits)
@@ -928,19 +1507,30 @@ class FCOS(nn.Module):
     def inference(
         self,
         images: torch.Tensor,
-        locations_per_fpn_level: Dict[str, torch.Tensor],
+        fpn_locations: FPNLocations,
         pred_cls_logits: Dict[str, torch.Tensor],
         pred_boxreg_deltas: Dict[str, torch.Tensor],
         pred_ctr_logits: Dict[str, torch.Tensor],
         test_score_thresh: float = 0.3,
         test_nms_thresh: float = 0.5,
+        test_per_image: bool = False,
+        test_return_candidates: bool = False,
     ):
         """
-        Run inference on a single input image (batch size = 1). Other input
-        arguments are same as those computed in `forward` method. This method
-        should not be called from anywhere except from inside `forward`.
+        Run inference on a batch of input images. Other input arguments are
+        same as those computed in `forward` method. This method should not be
+        called from anywhere except from inside `forward`.
+        Predictions of all images and FPN levels are decoded and thresholded
+        together, using locations of all levels concatenated (with their
+        per-location strides) in `fpn_locations`. NMS runs once for the
+        batch, with boxes grouped by (image, class).
+        If `test_return_candidates` is True, returns `DetectionCandidates`
+        of the batch before NMS: at most `test_pre_nms_topk` per level and
+        image, above `test_score_thresh` (all of them if it is `None`).
         Returns:
-            Three tensors:
+            If `test_per_image` is True, a list with one tuple of the three
+            tensors below per image in the batch. Otherwise (batch size must
+            be 1), the three tensors:
                 - pred_boxes: Tensor of shape `(N, 4)` giving *absolute* XYXY
                   co-ordinates of predicted boxes.
                 - pred_classes: Tensor of shape `(N, )` giving predicted class
@@ -951,99 +1541,424 @@ class FCOS(nn.Module):
                   where class_prob and ctrness are obtained by applying sigmoid
                   to corresponding logits.
         """
+        batch_size = images.shape[0]
+        if not (test_per_image or test_return_candidates) and batch_size != 1:
+            raise ValueError(
+                f"Got a batch of {batch_size} images, pass `test_per_image=True`"
+                " to get predictions of every image."
+            )
+
+        # Predictions of all levels, shapes: `(B, N, ...)` where `N` is the
+        # total number of locations across FPN levels.
+        pred_cls_logits = self._cat_across_fpn_levels(pred_cls_logits)
+        pred_boxreg_deltas = self._cat_across_fpn_levels(pred_boxreg_deltas)
+        pred_ctr_logits = self._cat_across_fpn_levels(pred_ctr_logits)
+
+        ######################################################################
+        # FCOS uses the geometric mean of class probability and centerness as
+        # the final confidence score. This helps in getting rid of excessive
+        # amount of boxes far away from object centers.
+        #
+        # Then perform the following steps in order, for all levels at once:
+        #   1. Select candidate (location, class) pairs: at most
+        #      `test_pre_nms_topk` highest scoring ones per level and image.
+        #   2. Only retain candidates that have a confidence score higher
+        #      than provided threshold in arguments.
+        #   3. Obtain predicted boxes using predicted deltas, locations and
+        #      strides of their FPN levels.
+        #   4. Clip XYXY box-cordinates that go beyond the height and
+        #      and width of input image.
+        ######################################################################
+        pred_scores = torch.sqrt(
+            pred_cls_logits.sigmoid() * pred_ctr_logits.sigmoid()
+        )
+
+        # Step 1:
+        # Every (location, class) pair is a candidate, not only the most
+        # confident class of a location. Candidate IDs index scores
+        # flattened across locations and classes: `(B, N * num_classes)`.
+        num_classes = pred_scores.shape[2]
+        pred_scores = pred_scores.flatten(1)
+        if self.test_pre_nms_topk is not None:
+            candidate_scores, candidate_ids = [], []
+            level_sizes = [
+                n * num_classes for n in fpn_locations.num_locations_per_level
+            ]
+            level_starts = [0] + list(itertools.accumulate(level_sizes))
+            for level_start, level_scores in zip(
+                level_starts, pred_scores.split(level_sizes, dim=1)
+            ):
+                level_scores, level_ids = level_scores.topk(
+                    min(self.test_pre_nms_topk, level_scores.shape[1]), dim=1
+                )
+                candidate_scores.append(level_scores)
+                candidate_ids.append(level_ids + level_start)
+            pred_scores = torch.cat(candidate_scores, dim=1)
+            candidate_ids = torch.cat(candidate_ids, dim=1)
+        else:
+            candidate_ids = torch.arange(
+                pred_scores.shape[1], device=pred_scores.device
+            ).expand_as(pred_scores)
+
+        # Step 2:
+        # Retained predictions of all images are flattened together,
+        # `pred_image_ids` gives the image each of them belongs to.
+        retain = (
+            pred_scores > test_score_thresh
+            if test_score_thresh is not None
+            else torch.ones_like(pred_scores, dtype=torch.bool)
+        )
+        pred_image_ids = retain.nonzero()[:, 0]
+        candidate_ids = candidate_ids[retain]
+        location_ids = candidate_ids // num_classes
+        pred_classes = candidate_ids % num_classes
+        pred_scores = pred_scores[retain]
+
+        # Step 3:
+        pred_boxes = fcos_apply_deltas_to_locations(
+            pred_boxreg_deltas[pred_image_ids, location_ids],
+            fpn_locations.locations[location_ids],
+            fpn_locations.strides[location_ids, None],
+        )
+
+        # Step 4:
+        H, W = images.shape[2], images.shape[3]
+        pred_boxes[:, 0::2].clamp_(min=0, max=W)
+        pred_boxes[:, 1::2].clamp_(min=0, max=H)
+
+        candidates = DetectionCandidates(
+            pred_image_ids, pred_boxes, pred_classes, pred_scores
+        )
+        if test_return_candidates:
+            return candidates
+
+        ######################################################################
+        # Perform NMS on predictions of all images.
+        preds_per_image = fcos_postprocess_candidates(
+            candidates,
+            num_images=batch_size,
+            num_classes=self.num_classes,
+            nms_thresh=test_nms_thresh,
+            max_detections=self.test_max_detections,
+        )
+        return preds_per_image if test_per_image else preds_per_image[0]
+
+
+class FCOSTargetDataset(torch.utils.data.Dataset):
+    """
+    Wrap a detection dataset (like `VOC2007DetectionTiny`) to also serve FCOS
+    training targets of every image: `(image_path, image, gt_boxes, targets)`
+    where `targets` is a dict as accepted by `FCOS.forward(gt_targets=...)`.
+    Targets are computed in DataLoader workers, off the critical path of the
+    training process (with `num_workers > 0`). Without random augmentation
+    they are identical every epoch, so they can be cached, keyed by image
+    path, GT boxes, input size and matching hyperparameters:
+      - on disk in `cache_dir` (recommended): shared by all workers, epochs
+        and training runs.
+      - in memory, per worker process, for at most `memory_cache_size`
+        images (least recently used are evicted). DataLoader workers are
+        recreated every epoch unless `persistent_workers=True`, so without
+        it this cache only helps within an epoch.
+    """
+
+    # Bump this when matching rules change, to invalidate disk caches.
+    MATCHING_VERSION = 1
+
+    def __init__(
+        self,
+        dataset: torch.utils.data.Dataset,
+        image_size: Tuple[int, int],
+        strides_per_fpn_level: Dict[str, int],
+        cache_dir: Optional[str] = None,
+        memory_cache_size: int = 1024,
+    ):
+        """
+        Args:
+            dataset: Dataset serving `(image_path, image, gt_boxes)`, with all
+                images of the same size.
+            image_size: `(height, width)` of images.
+            strides_per_fpn_level: Strides of FPN levels, use
+                `detector.backbone.fpn_strides`.
+            cache_dir: Directory to save targets in, optional. It can be shared
+                by all workers and training runs.
+            memory_cache_size: Maximum number of images to keep targets of in
+                memory, per worker process (0 to disable).
+        """
+        super().__init__()
+        self.dataset = dataset
+        self.image_size = tuple(image_size)
+        self.strides_per_fpn_level = dict(strides_per_fpn_level)
+        self.cache_dir = cache_dir
+        self.memory_cache_size = memory_cache_size
+        self._cache = collections.OrderedDict()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+        # Shapes of FPN features for this input size (B, C dims are unused).
+        height, width = self.image_size
+        self.shape_per_fpn_level = {
+            level_name: (
+                1, 1, math.ceil(height / stride), math.ceil(width / stride)
+            )
+            for level_name, stride in self.strides_per_fpn_level.items()
+        }
+
+    def __len__(self):
+        return len(self.dataset)
 
-        # Gather scores and boxes from all FPN levels in this list. Once
-        # gathered, we will perform NMS to filter highly overlapping predictions.
-        pred_boxes_all_levels = []
-        pred_classes_all_levels = []
-        pred_scores_all_levels = []
-
-        for level_name in locations_per_fpn_level.keys():
-
-            # Get locations and predictions from a single level.
-            # We index predictions by `[0]` to remove batch dimension.
-            level_locations = locations_per_fpn_level[level_name]
-            level_cls_logits = pred_cls_logits[level_name][0]
-            level_deltas = pred_boxreg_deltas[level_name][0]
-            level_ctr_logits = pred_ctr_logits[level_name][0]
-
-            ##################################################################
-            # TODO: FCOS uses the geometric mean of class probability and
-            # centerness as the final confidence score. This helps in getting
-            # rid of excessive amount of boxes far away from object centers.
-            # Compute this value here (recall sigmoid(logits) = probabilities)
-            #
-            # Then perform the following steps in order:
-            #   1. Get the most confidently predicted class and its score for
-            #      every box. Use level_pred_scores: (N, num_classes) => (N, )
-            #   2. Only retain prediction that have a confidence score higher
-            #      than provided threshold in arguments.
-            #   3. Obtain predicted boxes using predicted deltas and locations
-            #   4. Clip XYXY box-cordinates that go beyond the height and
-            #      and width of input image.
-            ##################################################################
-            # Feel free to delete this line: (but keep variable names same)
-            level_pred_boxes, level_pred_classes, level_pred_scores = (
-                None,
-                None,
-                None,  # Need tensors of shape: (N, 4) (N, ) (N, )
+    def _cache_key(self, image_path: str, gt_boxes: torch.Tensor) -> str:
+        key = (
+            f"{image_path}|{self.image_size}|"
+            f"{sorted(self.strides_per_fpn_level.items())}|"
+            f"v{self.MATCHING_VERSION}|"
+        )
+        # GT boxes are part of the key: annotations, crop or truncation of
+        # boxes may change between training runs sharing `cache_dir`.
+        gt_bytes = gt_boxes.detach().cpu().float().contiguous().numpy().tobytes()
+        return hashlib.sha1(key.encode() + gt_bytes).hexdigest()
+
+    def _make_targets(self, gt_boxes: torch.Tensor) -> TensorDict:
+        fpn_locations = get_fpn_all_level_locations(
+            self.shape_per_fpn_level, self.strides_per_fpn_level
+        )
+        gt_boxes = gt_boxes[gt_boxes[:, 4] != -1]
+        boxes, deltas, centerness = fcos_match_locations_to_gt_batched(
+            fpn_locations, gt_boxes[None].float()
+        )
+        return {
+            "boxes": boxes[0],
+            "deltas": deltas[0],
+            "centerness": centerness[0],
+        }
+
+    def __getitem__(self, index: int):
+        image_path, image, gt_boxes = self.dataset[index]
+        if tuple(image.shape[1:]) != self.image_size:
+            raise ValueError(
+                f"{image_path} has size {tuple(image.shape[1:])}, expected "
+                f"{self.image_size} for cached targets."
             )
 
-            # Compute geometric mean of class logits and centerness:
-            level_pred_scores = torch.sqrt(
-                level_cls_logits.sigmoid_() * level_ctr_logits.sigmoid_()
+        key = self._cache_key(image_path, gt_boxes)
+        targets = self._cache.get(key)
+        if targets is not None:
+            self._cache.move_to_end(key)
+        elif self.cache_dir is not None:
+            cache_path = os.path.join(self.cache_dir, f"{key}.pt")
+            if os.path.exists(cache_path):
+                targets = torch.load(cache_path)
+            else:
+                targets = self._make_targets(gt_boxes)
+                # Write and rename, so other workers never read partial files.
+                tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+                torch.save(targets, tmp_path)
+                os.replace(tmp_path, cache_path)
+        else:
+            targets = self._make_targets(gt_boxes)
+
+        if self.memory_cache_size > 0 and key not in self._cache:
+            self._cache[key] = targets
+            if len(self._cache) > self.memory_cache_size:
+                self._cache.popitem(last=False)
+
+        return image_path, image, gt_boxes, targets
+
+
+class CachedCandidates(NamedTuple):
+    """
+    `DetectionCandidates` of a whole dataset (with image IDs global across
+    batches, in order of the loader), along with GT boxes of every image.
+    Written by `cache_detection_candidates`.
+    """
+
+    candidates: DetectionCandidates
+    gt_boxes: PackedBoxes
+    num_classes: int
+    max_detections: Optional[int]
+
+
+def cache_detection_candidates(
+    detector: FCOS,
+    test_loader,
+    cache_path: Optional[str] = None,
+    min_score_thresh: Optional[float] = None,
+    dtype: torch.dtype = torch.float32,
+    device: str = "cpu",
+) -> CachedCandidates:
+    """
+    Run `detector` over `test_loader` once, and keep its candidates before NMS
+    (at most `detector.test_pre_nms_topk` per level and image). Candidates
+    do not depend on NMS threshold, or on score threshold above
+    `min_score_thresh`, so `sweep_detection_thresholds` can replay the rest
+    of inference for any of those. Saved to `cache_path` if given, load it
+    with `load_detection_candidates`.
+    """
+    detector.to(dtype=dtype, device=device)
+    detector.eval()
+
+    candidates, gt_boxes = [], []
+    num_images = 0
+    for _, images, batch_gt_boxes, *_ in test_loader:
+        # Same preprocessing as `inference_with_detector`.
+        images = prepare_images(images, dtype, device)
+
+        with torch.no_grad():
+            batch_candidates = detector(
+                images,
+                test_score_thresh=min_score_thresh,
+                test_return_candidates=True,
             )
-            # Step 1:
-            # Replace "PASS" statement with your code
-            level_pred_scores, level_pred_classes = torch.max(
-                level_pred_scores, dim=1)
-
-            # Step 2:
-            # Replace "PASS" statement with your code
-            retain = level_pred_scores > test_score_thresh
-            level_pred_boxes = level_deltas[retain]
-            level_pred_classes = level_pred_classes[retain]
-            level_pred_scores = level_pred_scores[retain]
-
-            # Step 3:  
-            # Replace "PASS" statement with your code
-            stride = 2 ** (int(level_name[1]) + 1)
-            level_pred_boxes = fcos_apply_deltas_to_locations(level_pred_boxes, level_locations, stride)
-
-            # Step 4: 
-            # Replace "PASS" statement with your code
-            H, W = images.shape[1], images.shape[2]
-            x = level_pred_boxes[..., 0::2].clamp(min=0, max=W)
-            y = level_pred_boxes[..., 1::2].clamp(min=0, max=H)
-            
-            level_pred_boxes[..., 0::2] = x
-            level_pred_boxes[..., 1::2] = y
-            ##################################################################
-            #                          END OF YOUR CODE                      #
-            ##################################################################
+        candidates.append(
+            DetectionCandidates(
+                batch_candidates.image_ids.cpu() + num_images,
+                *(tensor.cpu() for tensor in batch_candidates[1:]),
+            )
+        )
+        if isinstance(batch_gt_boxes, PackedBoxes):
+            batch_gt_boxes = batch_gt_boxes.unbind()
+        gt_boxes.extend(b[b[:, 4] != -1].cpu() for b in batch_gt_boxes)
+        num_images += images.shape[0]
+
+    if num_images == 0:
+        # Empty loader: no candidates and no GT boxes.
+        # fmt: off
+        candidates.append(DetectionCandidates(
+            torch.zeros(0, dtype=torch.long), torch.zeros(0, 4, dtype=dtype),
+            torch.zeros(0, dtype=torch.long), torch.zeros(0, dtype=dtype),
+        ))
+        # fmt: on
+        gt_boxes.append(torch.zeros(0, 5))
+        gt_offsets = torch.zeros(1, dtype=torch.long)
+    else:
+        gt_offsets = torch.tensor([0] + [len(b) for b in gt_boxes]).cumsum(0)
+
+    cached = CachedCandidates(
+        candidates=DetectionCandidates(*(torch.cat(c) for c in zip(*candidates))),
+        gt_boxes=PackedBoxes(
+            boxes=torch.cat(gt_boxes),
+            offsets=gt_offsets,
+        ),
+        num_classes=detector.num_classes,
+        max_detections=detector.test_max_detections,
+    )
+    if cache_path is not None:
+        torch.save(
+            {
+                "candidates": cached.candidates._asdict(),
+                "gt_boxes": cached.gt_boxes._asdict(),
+                "num_classes": cached.num_classes,
+                "max_detections": cached.max_detections,
+            },
+            cache_path,
+        )
+    return cached
+
+
+def load_detection_candidates(cache_path: str) -> CachedCandidates:
+    """Load candidates saved by `cache_detection_candidates`."""
+    cached = torch.load(cache_path)
+    return CachedCandidates(
+        candidates=DetectionCandidates(**cached["candidates"]),
+        gt_boxes=PackedBoxes(**cached["gt_boxes"]),
+        num_classes=cached["num_classes"],
+        max_detections=cached["max_detections"],
+    )
+
+
+def _evaluate_cached_candidates(
+    cached: CachedCandidates,
+    score_thresh: float,
+    nms_thresh: float,
+    images_per_chunk: int,
+) -> Dict:
+    candidates = cached.candidates
+    gt_boxes = cached.gt_boxes.unbind()
+    num_images = len(gt_boxes)
+
+    # Candidates are sorted by image ID: find the range of every chunk.
+    chunk_starts = list(range(0, num_images, images_per_chunk)) + [num_images]
+    bounds = torch.searchsorted(
+        candidates.image_ids, torch.tensor(chunk_starts)
+    ).tolist()
+
+    evaluator = VOCMeanAPEvaluator(cached.num_classes)
+    for i in range(len(chunk_starts) - 1):
+        first_image, last_image = chunk_starts[i], chunk_starts[i + 1]
+        rows = slice(bounds[i], bounds[i + 1])
+        chunk = DetectionCandidates(
+            candidates.image_ids[rows] - first_image,
+            candidates.boxes[rows],
+            candidates.classes[rows],
+            candidates.scores[rows],
+        )
+        preds_per_image = fcos_postprocess_candidates(
+            chunk,
+            num_images=last_image - first_image,
+            num_classes=cached.num_classes,
+            score_thresh=score_thresh,
+            nms_thresh=nms_thresh,
+            max_detections=cached.max_detections,
+        )
+        evaluator.update(
+            [
+                torch.cat(
+                    [boxes, classes[:, None].to(boxes), scores[:, None]], dim=1
+                )
+                for boxes, classes, scores in preds_per_image
+            ],
+            gt_boxes[first_image:last_image],
+        )
+    return evaluator.compute()
 
-            pred_boxes_all_levels.append(level_pred_boxes)
-            pred_classes_all_levels.append(level_pred_classes)
-            pred_scores_all_levels.append(level_pred_scores)
 
-        ######################################################################
-        # Combine predictions from all levels and perform NMS.
-        pred_boxes_all_levels = torch.cat(pred_boxes_all_levels)
-        pred_classes_all_levels = torch.cat(pred_classes_all_levels)
-        pred_scores_all_levels = torch.cat(pred_scores_all_levels)
-
-        # STUDENTS: This function depends on your implementation of NMS.
-        keep = class_spec_nms(
-            pred_boxes_all_levels,
-            pred_scores_all_levels,
-            pred_classes_all_levels,
-            iou_threshold=test_nms_thresh,
+# Candidates of a worker process of `sweep_detection_thresholds`, set once
+# per process by `_init_sweep_worker`.
+_sweep_worker_state = {}
+
+
+def _init_sweep_worker(cached: CachedCandidates):
+    # Parallelism comes from processes: one PyTorch thread each.
+    set_cpu_threads(1, 1)
+    _sweep_worker_state["cached"] = cached
+
+
+def _evaluate_sweep_point(
+    score_thresh: float, nms_thresh: float, images_per_chunk: int
+) -> Dict:
+    return _evaluate_cached_candidates(
+        _sweep_worker_state["cached"], score_thresh, nms_thresh, images_per_chunk
+    )
+
+
+def sweep_detection_thresholds(
+    cached: CachedCandidates,
+    score_threshs: List[float],
+    nms_threshs: List[float],
+    num_workers: Optional[int] = None,
+    images_per_chunk: int = 64,
+) -> Dict[Tuple[float, float], Dict]:
+    """
+    Evaluate mAP for every combination of score and NMS thresholds, by
+    replaying only thresholding, NMS and evaluation on `cached` candidates
+    (from `cache_detection_candidates`). Combinations are evaluated in
+    parallel by `num_workers` spawned processes (one per core by default),
+    each with a single PyTorch thread, over chunks of `images_per_chunk`
+    images to bound NMS cost. `cached` is sent once to every process.
+    Returns:
+        Dictionary from `(score_thresh, nms_thresh)` to results of
+        `VOCMeanAPEvaluator.compute`.
+    """
+    grid = [(s, n) for s in score_threshs for n in nms_threshs]
+    if not grid:
+        return {}
+    num_workers = min(num_workers or os.cpu_count() or 1, len(grid))
+    context = torch.multiprocessing.get_context("spawn")
+    with context.Pool(
+        num_workers, initializer=_init_sweep_worker, initargs=(cached,)
+    ) as pool:
+        # `starmap` returns results in order of the grid.
+        results = pool.starmap(
+            _evaluate_sweep_point,
+            [(s, n, images_per_chunk) for s, n in grid],
         )
-        pred_boxes_all_levels = pred_boxes_all_levels[keep]
-        pred_classes_all_levels = pred_classes_all_levels[keep]
-        pred_scores_all_levels = pred_scores_all_levels[keep]
-        return (
-            pred_boxes_all_levels,
-            pred_classes_all_levels,
-            pred_scores_all_levels,
-        )
\ No newline at end of file
+    return dict(zip(grid, results))
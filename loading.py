@@ -1,16 +1,260 @@
-from typing import Optional
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
 
+import io
 import json
+import math
+import multiprocessing
 import os
+import queue
 import shutil
+import tarfile
+import threading
 import time
 
 import cs639
 import matplotlib.pyplot as plt
+import numpy as np
 import torch
 from PIL import Image
 from torch import optim
 from torchvision import transforms
+from torchvision.ops import box_iou
+
+
+# Name of the PASCAL VOC 2007 tar file downloaded to `dataset_dir`.
+VOC_TAR_NAME = "VOCtrainval_06-Nov-2007.tar"
+
+# ImageNet color statistics used to normalize images for the backbone.
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+
+
+def normalize_images(
+    images: torch.Tensor, dtype: torch.dtype = torch.float32
+) -> torch.Tensor:
+    """
+    Normalize a batch of `uint8` images `(B, 3, H, W)` (or a single `(3, H, W)`
+    image) by ImageNet color statistics, in one vectorized step. This is the
+    batch-time equivalent of `transforms.ToTensor` + `transforms.Normalize`
+    used in `VOC2007DetectionTiny`. Run it after moving images to the target
+    device to keep host-to-device copies at one byte per pixel.
+    """
+    mean = torch.tensor(IMAGENET_MEAN, dtype=dtype, device=images.device)
+    std = torch.tensor(IMAGENET_STD, dtype=dtype, device=images.device)
+    images = images.to(dtype).div_(255.0)
+    return images.sub_(mean[:, None, None]).div_(std[:, None, None])
+
+
+class PackedBoxes(NamedTuple):
+    """
+    Ragged batch of GT boxes, an alternative to padding every image to a fixed
+    number of boxes. `boxes` is a `(total_num_boxes, 5)` tensor of boxes of
+    all images concatenated, and `offsets` is a `(B + 1, )` long tensor such
+    that boxes of image `i` are `boxes[offsets[i]:offsets[i + 1]]`.
+    """
+
+    boxes: torch.Tensor
+    offsets: torch.Tensor
+
+    @property
+    def num_images(self) -> int:
+        return len(self.offsets) - 1
+
+    def to(self, *args, **kwargs) -> "PackedBoxes":
+        # Offsets are only used for slicing, keep them on CPU.
+        return PackedBoxes(self.boxes.to(*args, **kwargs), self.offsets)
+
+    def unbind(self) -> List[torch.Tensor]:
+        """Split into a list of `(M_i, 5)` GT boxes, one per image."""
+        return list(torch.split(self.boxes, self.offsets.diff().tolist()))
+
+    def to_padded(self) -> torch.Tensor:
+        """Pad with -1 to `(B, max_M, 5)`, only as many rows as needed."""
+        return torch.nn.utils.rnn.pad_sequence(
+            self.unbind(), batch_first=True, padding_value=-1.0
+        )
+
+
+class DetectionCollate:
+    """
+    Collate function for `DataLoader` of detection datasets that serve
+    `(image_path, image, gt_boxes)` samples. Images are stacked as usual.
+    GT boxes are either padded with -1 up to the largest number of boxes in
+    the batch, `(B, max_M, 5)`, or packed as `PackedBoxes` if `ragged_gt`.
+    If `normalize`, batches of `uint8` images are normalized in one step
+    (prefer normalizing on device, to keep worker IPC at one byte per pixel).
+    """
+
+    def __init__(
+        self,
+        ragged_gt: bool = False,
+        size_divisibility: int = 1,
+        normalize: bool = False,
+    ):
+        self.ragged_gt = ragged_gt
+        self.size_divisibility = size_divisibility
+        self.normalize = normalize
+
+    def _pad_images(self, images):
+        """
+        Pad images of different sizes at bottom and right (so GT boxes stay
+        valid), to the largest size in batch rounded up to `size_divisibility`.
+        """
+        height = max(image.shape[1] for image in images)
+        width = max(image.shape[2] for image in images)
+        height = -(-height // self.size_divisibility) * self.size_divisibility
+        width = -(-width // self.size_divisibility) * self.size_divisibility
+
+        batch = images[0].new_zeros((len(images), 3, height, width))
+        if batch.dtype == torch.uint8:
+            # Pad with mean color, that is zero after normalization.
+            mean = torch.tensor(IMAGENET_MEAN) * 255
+            batch += mean.round().to(torch.uint8)[:, None, None]
+        for image, padded_image in zip(images, batch):
+            padded_image[:, : image.shape[1], : image.shape[2]].copy_(image)
+        return batch
+
+    def __call__(self, batch):
+        # Extra items after GT boxes (e.g. training targets) use default collate.
+        image_paths, images, gt_boxes, *extras = zip(*batch)
+        shapes = {tuple(image.shape) for image in images}
+        _, height, width = images[0].shape
+        if (
+            len(shapes) == 1
+            and height % self.size_divisibility == 0
+            and width % self.size_divisibility == 0
+        ):
+            images = torch.stack(images)
+        else:
+            images = self._pad_images(images)
+
+        if self.normalize and images.dtype == torch.uint8:
+            images = normalize_images(images)
+
+        extras = [torch.utils.data.default_collate(extra) for extra in extras]
+
+        if self.ragged_gt:
+            offsets = torch.zeros(len(gt_boxes) + 1, dtype=torch.long)
+            offsets[1:] = torch.tensor([len(b) for b in gt_boxes]).cumsum(dim=0)
+            gt_boxes = PackedBoxes(torch.cat(gt_boxes), offsets)
+        else:
+            gt_boxes = torch.nn.utils.rnn.pad_sequence(
+                gt_boxes, batch_first=True, padding_value=-1.0
+            )
+        return (list(image_paths), images, gt_boxes, *extras)
+
+
+class AspectRatioBatchSampler(torch.utils.data.Sampler):
+    """
+    Batch sampler that puts images of similar aspect ratio in the same batch,
+    so images that keep their aspect ratio (no center crop) can be batched
+    with little padding. Images are sorted by aspect ratio and consecutive
+    chunks of `batch_size` form the batches; with `shuffle`, the order of
+    batches is randomized every epoch.
+    """
+
+    def __init__(
+        self,
+        aspect_ratios,
+        batch_size: int,
+        shuffle: bool = False,
+        drop_last: bool = False,
+    ):
+        super().__init__(None)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+        order = torch.argsort(torch.as_tensor(aspect_ratios), stable=True)
+        self.batches = list(torch.split(order, batch_size))
+        if drop_last and len(self.batches[-1]) < batch_size:
+            self.batches.pop()
+
+    def __iter__(self):
+        batch_order = range(len(self.batches))
+        if self.shuffle:
+            batch_order = torch.randperm(len(self.batches)).tolist()
+        for batch_idx in batch_order:
+            yield self.batches[batch_idx].tolist()
+
+    def __len__(self):
+        return len(self.batches)
+
+
+class SharedImageCache:
+    """
+    Size-bounded cache of `uint8` CHW images with least-recently-used eviction.
+    All storage and bookkeeping are tensors in shared memory, with a process
+    lock around them: an instance created before DataLoader workers start is
+    shared by all of them (and across epochs, with `persistent_workers`).
+    Images are stored in fixed-size slots of `max_image_numel` bytes.
+    """
+
+    def __init__(self, num_images: int, max_image_numel: int, capacity: int):
+        """
+        Args:
+            num_images: Number of images in dataset, images are keyed by index.
+            max_image_numel: Number of elements of the largest image.
+            capacity: Memory budget of the cache, in bytes.
+        """
+        if capacity < max_image_numel:
+            raise ValueError(
+                f"Cache capacity of {capacity} bytes can not hold a single "
+                f"image of {max_image_numel} bytes."
+            )
+        # Shared memory is allocated up front: no more slots than images.
+        num_slots = min(num_images, capacity // max_image_numel)
+        self.slots = torch.empty(num_slots, max_image_numel, dtype=torch.uint8)
+        self.slot_shapes = torch.zeros(num_slots, 3, dtype=torch.long)
+        self.slot_of_image = torch.full((num_images,), -1, dtype=torch.long)
+        self.image_of_slot = torch.full((num_slots,), -1, dtype=torch.long)
+
+        # Logical clock: every access stamps the slot with the next tick.
+        # Empty slots have stamp 0, they are always evicted first.
+        self.last_used = torch.zeros(num_slots, dtype=torch.long)
+        self.clock = torch.zeros(1, dtype=torch.long)
+
+        # fmt: off
+        for tensor in (
+            self.slots, self.slot_shapes, self.slot_of_image,
+            self.image_of_slot, self.last_used, self.clock,
+        ):
+            tensor.share_memory_()
+        # fmt: on
+        # A spawn-context lock can be both inherited by forked processes
+        # (e.g. DataLoader workers) and pickled into spawned ones (e.g.
+        # `evaluate_detector_sharded`); a default (fork) lock on Linux can not.
+        self.lock = multiprocessing.get_context("spawn").Lock()
+
+    def _touch(self, slot: int):
+        self.clock += 1
+        self.last_used[slot] = self.clock[0]
+
+    def get(self, index: int) -> Optional[torch.Tensor]:
+        """Return a copy of cached image at `index`, or `None` on a miss."""
+        with self.lock:
+            slot = int(self.slot_of_image[index])
+            if slot < 0:
+                return None
+            self._touch(slot)
+            shape = self.slot_shapes[slot].tolist()
+            numel = shape[0] * shape[1] * shape[2]
+            return self.slots[slot, :numel].view(shape).clone()
+
+    def put(self, index: int, image: torch.Tensor):
+        """Cache `image` at `index`, evicting the least recently used image."""
+        with self.lock:
+            if self.slot_of_image[index] >= 0:
+                return
+            slot = int(self.last_used.argmin())
+            evicted = int(self.image_of_slot[slot])
+            if evicted >= 0:
+                self.slot_of_image[evicted] = -1
+
+            self.slots[slot, : image.numel()].copy_(image.flatten())
+            self.slot_shapes[slot] = torch.tensor(image.shape)
+            self.slot_of_image[index] = slot
+            self.image_of_slot[slot] = index
+            self._touch(slot)
 
 
 class VOC2007DetectionTiny(torch.utils.data.Dataset):
@@ -25,6 +269,13 @@ class VOC2007DetectionTiny(torch.utils.data.Dataset):
         split: str = "train",
         download: bool = False,
         image_size: int = 224,
+        shard_path: Optional[str] = None,
+        max_gt_boxes: Optional[int] = 40,
+        center_crop: bool = True,
+        draft_decode: bool = True,
+        from_tar: bool = False,
+        uint8_images: bool = False,
+        cache_size_mb: int = 0,
     ):
         """
         Args:
@@ -32,13 +283,50 @@ class VOC2007DetectionTiny(torch.utils.data.Dataset):
             image_size: Size of imges in the batch. The shorter edge of images
                 will be resized to this size, followed by a center crop. For
                 val, center crop will not be taken to capture all detections.
+            shard_path: Path to an image shard written by `pack_voc_shard`.
+                If provided, images are read from this memory-mapped file as
+                already resized and cropped `uint8` CHW tensors, instead of
+                being decoded from JPEGs. Such images are NOT normalized, use
+                `normalize_images` on the batch (`train_detector` and
+                `inference_with_detector` do this automatically).
+            max_gt_boxes: Number of rows GT boxes of every image are padded
+                to (with -1). If `None`, only the valid `(M, 5)` boxes of an
+                image are served: use `DetectionCollate(ragged_gt=True)` to
+                batch them as `PackedBoxes`.
+            center_crop: Whether to center crop images after resizing. Set to
+                `False` for val to keep the aspect ratio of every image: use
+                `DetectionCollate(size_divisibility=32)` to pad such images
+                to a common size, and `AspectRatioBatchSampler` so that they
+                need little padding.
+            draft_decode: Whether to let the JPEG decoder downscale images
+                in DCT domain (PIL draft mode) to the smallest scale that is
+                not smaller than the resized image, before the final resize.
+                This is several times faster to decode, and the resized image
+                has exactly the same size as without it.
+            from_tar: Whether to read images directly from the VOC tar file in
+                `dataset_dir`, instead of the extracted JPEG files. An index
+                of member offsets is built once (see `build_voc_tar_index`),
+                then images are read with positional reads on one file
+                descriptor per process. `download` skips the extraction.
+            uint8_images: Whether to serve images as `uint8` CHW tensors that
+                are NOT normalized (always the case with `shard_path`). This
+                sends 4x fewer bytes from DataLoader workers; normalize the
+                batch with `normalize_images` or `DetectionCollate`.
+            cache_size_mb: Memory budget (in MB) of a `SharedImageCache` of
+                decoded and resized images, shared by all DataLoader workers.
+                Useful when iterating over the same images many times. Not
+                used with `shard_path`. Set to 0 to disable.
         """
         super().__init__()
         self.image_size = image_size
+        self.max_gt_boxes = max_gt_boxes
+        self.center_crop = center_crop
+        self.draft_decode = draft_decode
+        self.uint8_images = uint8_images
 
         # Attempt to download the dataset from Yong Jae's server:
         if download:
-            self._attempt_download(dataset_dir)
+            self._attempt_download(dataset_dir, extract=not from_tar)
 
         # fmt: off
         voc_classes = [
@@ -57,26 +345,143 @@ class VOC2007DetectionTiny(torch.utils.data.Dataset):
             _idx: _class for _idx, _class in enumerate(voc_classes)
         }
 
-        # Load instances from JSON file:
-        self.instances = json.load(
-            open(os.path.join(dataset_dir, f"voc07_{split}.json"))
-        )
+        # Load instances from JSON file. These nested lists of dicts are only
+        # used during construction: they are converted to a few flat arrays
+        # below so that forked DataLoader workers do not touch (and hence
+        # copy-on-write) millions of Python objects through refcounting.
+        with open(os.path.join(dataset_dir, f"voc07_{split}.json")) as f:
+            instances = json.load(f)
         self.dataset_dir = dataset_dir
 
-        # Define a transformation function for image: Resize the shorter image
-        # edge then take a center crop (optional) and normalize.
-        _transforms = [
-            transforms.Resize(image_size),
-            transforms.CenterCrop(image_size),
-            transforms.ToTensor(),
-            transforms.Normalize(
-                mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]
-            ),
+        # Pack all image paths in a single byte buffer, with `(N + 1, )`
+        # offsets delimiting the path of every image.
+        image_paths = [
+            self._full_image_path(image_path).encode()
+            for image_path, _ in instances
         ]
-        self.image_transform = transforms.Compose(_transforms)
+        self._path_offsets = np.zeros(len(image_paths) + 1, dtype=np.int64)
+        self._path_offsets[1:] = np.cumsum([len(p) for p in image_paths])
+        self._path_buffer = np.frombuffer(b"".join(image_paths), dtype=np.uint8)
+
+        # Define a transformation function for image: Resize the shorter image
+        # edge then take a center crop (optional). This is applied on PIL
+        # images, followed by conversion to a normalized tensor.
+        _transforms = [transforms.Resize(image_size)]
+        if center_crop:
+            _transforms.append(transforms.CenterCrop(image_size))
+        self.resize_transform = transforms.Compose(_transforms)
+        if uint8_images:
+            self.image_transform = transforms.PILToTensor()
+        else:
+            self.image_transform = transforms.Compose(
+                [
+                    transforms.ToTensor(),
+                    transforms.Normalize(mean=IMAGENET_MEAN, std=IMAGENET_STD),
+                ]
+            )
+
+        # Index of the pre-decoded image shard (optional). The shard itself is
+        # memory-mapped lazily, so every DataLoader worker maps the same pages.
+        self.shard_path = shard_path
+        self._shard = None
+        if shard_path is not None:
+            shard_index = np.load(_shard_index_path(shard_path))
+            if int(shard_index["image_size"]) != image_size:
+                raise ValueError(
+                    f"Shard {shard_path} was packed with image size "
+                    f"{int(shard_index['image_size'])}, expected {image_size}."
+                )
+            if bool(shard_index["center_crop"]) != center_crop:
+                raise ValueError(
+                    f"Shard {shard_path} was packed with center_crop = "
+                    f"{bool(shard_index['center_crop'])}."
+                )
+            if len(shard_index["shapes"]) != len(instances):
+                raise ValueError(
+                    f"Shard {shard_path} has {len(shard_index['shapes'])} "
+                    f"images, expected {len(instances)} for '{split}'."
+                )
+            self._shard_offsets = shard_index["offsets"]
+            self._shard_shapes = shard_index["shapes"]
+            self._shard_original_sizes = shard_index["original_sizes"]
+
+        # Byte ranges of images in the VOC tar file (optional). The tar file
+        # is opened lazily, once per process.
+        self.tar_path = None
+        self._tar_fd, self._tar_pid = None, None
+        if from_tar:
+            self.tar_path = os.path.join(dataset_dir, VOC_TAR_NAME)
+            self._load_tar_index(
+                [os.path.relpath(p.decode(), dataset_dir) for p in image_paths]
+            )
+
+        # Transform GT boxes once for the whole split, `__getitem__` only
+        # slices them: (num_boxes, 5) boxes and (N + 1, ) offsets per image.
+        self._original_sizes = self._read_original_sizes()
+        self._gt_boxes, self._gt_offsets = self._build_gt_boxes(
+            instances, self._original_sizes
+        )
+
+        # Cache of decoded images (optional). Created here so that tensors in
+        # shared memory are inherited by (or sent to) DataLoader workers.
+        self._cache = None
+        if cache_size_mb > 0 and shard_path is None:
+            if center_crop and image_size is not None:
+                max_image_numel = 3 * image_size * image_size
+            else:
+                max_image_numel = max(
+                    3 * width * height
+                    for width, height in map(self._resized_size, range(len(self)))
+                )
+            self._cache = SharedImageCache(
+                len(self), max_image_numel, cache_size_mb * 2**20
+            )
+
+    @property
+    def aspect_ratios(self) -> np.ndarray:
+        """Width / height of every image, shape `(N, )`."""
+        return self._original_sizes[:, 0] / self._original_sizes[:, 1]
+
+    def _load_tar_index(self, member_names: List[str]):
+        """
+        Look up data offsets, sizes and image sizes of `member_names` in the
+        tar index, building the index first if it does not exist.
+        """
+        index_path = _tar_index_path(self.tar_path)
+        if not os.path.exists(index_path):
+            build_voc_tar_index(self.tar_path)
+        tar_index = np.load(index_path)
+
+        names, name_offsets = tar_index["names"], tar_index["name_offsets"]
+        row_of_member = {
+            names[start:end].tobytes().decode(): row
+            for row, (start, end) in enumerate(
+                zip(name_offsets[:-1], name_offsets[1:])
+            )
+        }
+        try:
+            rows = np.array([row_of_member[name] for name in member_names])
+        except KeyError as e:
+            raise FileNotFoundError(f"{e} is not in {self.tar_path}") from None
+
+        self._tar_data_offsets = tar_index["data_offsets"][rows]
+        self._tar_data_sizes = tar_index["data_sizes"][rows]
+        self._tar_original_sizes = tar_index["image_sizes"][rows]
+
+    def _read_tar_member(self, index: int) -> bytes:
+        """
+        Read the encoded image from the tar file. `os.pread` does not move the
+        file offset, but we still re-open the file in every forked process.
+        """
+        if self._tar_fd is None or self._tar_pid != os.getpid():
+            self._tar_fd = os.open(self.tar_path, os.O_RDONLY)
+            self._tar_pid = os.getpid()
+
+        size = int(self._tar_data_sizes[index])
+        return os.pread(self._tar_fd, size, int(self._tar_data_offsets[index]))
 
     @staticmethod
-    def _attempt_download(dataset_dir: str):
+    def _attempt_download(dataset_dir: str, extract: bool = True):
         """
         Try to download VOC dataset and save it to `dataset_dir`.
         """
@@ -99,87 +504,832 @@ class VOC2007DetectionTiny(torch.utils.data.Dataset):
         # fmt: on
 
         # Extract TAR file:
-        import tarfile
-
-        voc_tar = tarfile.open(
-            os.path.join(dataset_dir, "VOCtrainval_06-Nov-2007.tar")
-        )
-        voc_tar.extractall(dataset_dir)
-        voc_tar.close()
+        if extract:
+            voc_tar = tarfile.open(os.path.join(dataset_dir, VOC_TAR_NAME))
+            voc_tar.extractall(dataset_dir)
+            voc_tar.close()
 
     def __len__(self):
-        return len(self.instances)
+        return len(self._path_offsets) - 1
 
-    def __getitem__(self, index: int):
-        # PIL image and dictionary of annotations.
-        image_path, ann = self.instances[index]
+    def close(self):
+        """Close the tar file descriptor opened by this process, if any."""
+        if self._tar_fd is not None and self._tar_pid == os.getpid():
+            os.close(self._tar_fd)
+        self._tar_fd, self._tar_pid = None, None
+
+    def __del__(self):
+        # May run on a partially initialized instance.
+        if getattr(self, "_tar_fd", None) is not None:
+            self.close()
+
+    def __getstate__(self):
+        # Do not pickle the memory map (e.g. for spawned DataLoader workers),
+        # every process maps the shard on its own.
+        state = self.__dict__.copy()
+        state["_shard"] = None
+        state["_tar_fd"], state["_tar_pid"] = None, None
+        return state
+
+    def _full_image_path(self, image_path: str) -> str:
         # TODO: Remove this after the JSON files are fixed on Yong Jae's server:
         image_path = image_path.replace("./here/", "")
-        image_path = os.path.join(self.dataset_dir, image_path)
-        image = Image.open(image_path).convert("RGB")
+        return os.path.join(self.dataset_dir, image_path)
+
+    def _image_path(self, index: int) -> str:
+        start, end = self._path_offsets[index], self._path_offsets[index + 1]
+        return self._path_buffer[start:end].tobytes().decode()
+
+    def _read_shard_image(self, index: int) -> torch.Tensor:
+        """
+        Get a pre-decoded `uint8` CHW image from the shard.
+        """
+        if self._shard is None:
+            # Copy-on-write mapping: pages are shared with other processes
+            # and tensors can be created without copying or warnings.
+            self._shard = np.memmap(self.shard_path, dtype=np.uint8, mode="c")
+
+        start, end = self._shard_offsets[index], self._shard_offsets[index + 1]
+        image = self._shard[start:end].reshape(self._shard_shapes[index])
+        return torch.from_numpy(image)
+
+    def _resized_size(self, index: int):
+        """
+        Compute `(width, height)` of image after resizing like
+        `transforms.Resize`, from the original size: GT boxes were
+        transformed using it.
+        """
+        width, height = (int(x) for x in self._original_sizes[index])
+        if self.image_size is None:
+            return width, height
+
+        short, long = min(width, height), max(width, height)
+        new_short = self.image_size
+        new_long = int(self.image_size * long / short)
+        if width <= height:
+            return new_short, new_long
+        return new_long, new_short
+
+    def _load_image(self, index: int) -> Image.Image:
+        """
+        Decode an image and apply `resize_transform` on it, returns PIL image.
+        """
+        if self.tar_path is not None:
+            image = Image.open(io.BytesIO(self._read_tar_member(index)))
+        else:
+            image = Image.open(self._image_path(index))
+
+        if self.draft_decode and self.image_size is not None:
+            new_size = self._resized_size(index)
+
+            # JPEG decoder picks a scale (1/2, 1/4, 1/8) such that size of
+            # decoded image is at least `new_size`; no-op for other formats.
+            image.draft("RGB", new_size)
+            image = image.convert("RGB")
+            if image.size != new_size:
+                image = image.resize(new_size, Image.BILINEAR)
+        else:
+            image = image.convert("RGB")
+
+        return self.resize_transform(image)
+
+    def _read_original_sizes(self) -> np.ndarray:
+        """
+        Get `(width, height)` of all images before resizing, shape `(N, 2)`.
+        PIL only parses the JPEG header here, images are not decoded.
+        """
+        if self.shard_path is not None:
+            return self._shard_original_sizes
+        if self.tar_path is not None:
+            return self._tar_original_sizes
+
+        original_sizes = np.zeros((len(self), 2), dtype=np.int64)
+        for index in range(len(self)):
+            with Image.open(self._image_path(index)) as image:
+                original_sizes[index] = image.size
+        return original_sizes
+
+    def _build_gt_boxes(self, instances: list, original_sizes: np.ndarray):
+        """
+        Transform GT boxes of ALL images in the split at once, the same way
+        as images are resized and center cropped. Returns a `(num_boxes, 5)`
+        float32 array of `(x1, y1, x2, y2, C)` boxes of all images, and
+        `(N + 1, )` offsets such that boxes of image `i` are in rows
+        `offsets[i]:offsets[i + 1]`.
+        """
+        num_boxes = [len(ann) for _, ann in instances]
+        gt_offsets = np.zeros(len(num_boxes) + 1, dtype=np.int64)
 
         # Collect a list of GT boxes: (N, 4), and GT classes: (N, )
-        gt_boxes = torch.tensor([inst["xyxy"] for inst in ann])
-        gt_classes = torch.Tensor([self.class_to_idx[inst["name"]] for inst in ann])
+        anns = [inst for _, ann in instances for inst in ann]
+        gt_boxes = torch.tensor(
+            [inst["xyxy"] for inst in anns], dtype=torch.float32
+        ).view(-1, 4)
+        gt_classes = torch.tensor(
+            [self.class_to_idx[inst["name"]] for inst in anns],
+            dtype=torch.float32,
+        )
         gt_classes = gt_classes.unsqueeze(1)  # (N, 1)
 
-        # Record original image size before transforming.
-        original_width, original_height = image.size
+        # Original image size of every box: (N, 1) each.
+        original_sizes = torch.from_numpy(original_sizes).repeat_interleave(
+            torch.tensor(num_boxes, dtype=torch.long), dim=0
+        )
+        original_sizes = original_sizes.double()
+        original_width, original_height = original_sizes.unbind(dim=1)
+        original_width = original_width[:, None]
+        original_height = original_height[:, None]
 
         # Normalize bounding box co-ordinates to bring them in [0, 1]. This is
         # temporary, simply to ease the transformation logic.
-        normalize_tens = torch.tensor(
-            [original_width, original_height, original_width, original_height]
+        normalize_tens = torch.cat(
+            [original_width, original_height, original_width, original_height],
+            dim=1,
         )
-        gt_boxes /= normalize_tens[None, :]
-
-        # Transform input image to CHW tensor.
-        image = self.image_transform(image)
+        gt_boxes /= normalize_tens.float()
 
         # WARN: Even dimensions should be even numbers else it messes up
         # upsampling in FPN.
 
         # Apply image resizing transformation to bounding boxes.
         if self.image_size is not None:
-            if original_height >= original_width:
-                new_width = self.image_size
-                new_height = original_height * self.image_size / original_width
+            portrait = original_height >= original_width
+            new_width = torch.where(
+                portrait,
+                torch.full_like(original_width, self.image_size),
+                original_width * self.image_size / original_height,
+            )
+            new_height = torch.where(
+                portrait,
+                original_height * self.image_size / original_width,
+                torch.full_like(original_height, self.image_size),
+            )
+
+            if self.center_crop:
+                _x1 = torch.div(new_width - self.image_size, 2, rounding_mode="floor")
+                _y1 = torch.div(new_height - self.image_size, 2, rounding_mode="floor")
+                max_x = max_y = torch.tensor(float(self.image_size))
             else:
-                new_height = self.image_size
-                new_width = original_width * self.image_size / original_height
+                # No crop, `transforms.Resize` truncates the longer edge.
+                _x1, _y1 = torch.zeros_like(new_width), torch.zeros_like(new_height)
+                max_x, max_y = new_width.floor().float(), new_height.floor().float()
 
-            _x1 = (new_width - self.image_size) // 2
-            _y1 = (new_height - self.image_size) // 2
+            new_width, new_height = new_width.float(), new_height.float()
+            _x1, _y1 = _x1.float(), _y1.float()
 
             # Un-normalize bounding box co-ordinates and shift due to center crop.
             # Clamp to (0, image size).
-            gt_boxes[:, 0] = torch.clamp(gt_boxes[:, 0] * new_width - _x1, min=0)
-            gt_boxes[:, 1] = torch.clamp(gt_boxes[:, 1] * new_height - _y1, min=0)
-            gt_boxes[:, 2] = torch.clamp(
-                gt_boxes[:, 2] * new_width - _x1, max=self.image_size
-            )
-            gt_boxes[:, 3] = torch.clamp(
-                gt_boxes[:, 3] * new_height - _y1, max=self.image_size
-            )
+            gt_boxes[:, 0::2] = gt_boxes[:, 0::2] * new_width - _x1
+            gt_boxes[:, 1::2] = gt_boxes[:, 1::2] * new_height - _y1
+            gt_boxes[:, :2] = gt_boxes[:, :2].clamp(min=0)
+            gt_boxes[:, 2] = torch.minimum(gt_boxes[:, 2], max_x.flatten())
+            gt_boxes[:, 3] = torch.minimum(gt_boxes[:, 3], max_y.flatten())
 
         # Concatenate GT classes with GT boxes; shape: (N, 5)
         gt_boxes = torch.cat([gt_boxes, gt_classes], dim=1)
 
         # Center cropping may completely exclude certain boxes that were close
-        # to image boundaries. Set them to -1
-        invalid = (gt_boxes[:, 0] > gt_boxes[:, 2]) | (
-            gt_boxes[:, 1] > gt_boxes[:, 3]
+        # to image boundaries. Drop them, padding takes their place.
+        valid = (gt_boxes[:, 0] <= gt_boxes[:, 2]) & (
+            gt_boxes[:, 1] <= gt_boxes[:, 3]
         )
-        gt_boxes[invalid] = -1
-
-        # Pad to max 40 boxes, that's enough for VOC.
-        gt_boxes = torch.cat(
-            [gt_boxes, torch.zeros(40 - len(gt_boxes), 5).fill_(-1.0)]
+        image_ids = torch.arange(len(num_boxes)).repeat_interleave(
+            torch.tensor(num_boxes, dtype=torch.long)
         )
+        num_valid = torch.bincount(image_ids[valid], minlength=len(num_boxes))
+        gt_offsets[1:] = num_valid.cumsum(dim=0).numpy()
+        return gt_boxes[valid].numpy(), gt_offsets
+
+    def __getitem__(self, index: int):
+        image_path = self._image_path(index)
+
+        if self.shard_path is not None:
+            image = self._read_shard_image(index)
+        elif self._cache is not None:
+            # Cache keeps `uint8` images, normalize after reading (if needed).
+            image = self._cache.get(index)
+            if image is None:
+                image = self._load_image(index)
+                image = transforms.functional.pil_to_tensor(image)
+                self._cache.put(index, image)
+            if not self.uint8_images:
+                image = normalize_images(image)
+        else:
+            # Transform input image to CHW tensor.
+            image = self.image_transform(self._load_image(index))
+
+        # GT boxes of this image were transformed in `__init__`, just slice.
+        start, end = self._gt_offsets[index], self._gt_offsets[index + 1]
+        gt_boxes = torch.from_numpy(self._gt_boxes[start:end])
+
+        if self.max_gt_boxes is None:
+            # Copy, else the whole array is sent from DataLoader workers.
+            gt_boxes = gt_boxes.clone()
+        else:
+            if len(gt_boxes) > self.max_gt_boxes:
+                raise ValueError(
+                    f"{image_path} has {len(gt_boxes)} GT boxes, more than "
+                    f"max_gt_boxes = {self.max_gt_boxes}."
+                )
+            # Pad to max 40 boxes (by default), that's enough for VOC.
+            num_padding = self.max_gt_boxes - len(gt_boxes)
+            gt_boxes = torch.cat(
+                [gt_boxes, torch.zeros(num_padding, 5).fill_(-1.0)]
+            )
         # Return image path because it is needed for evaluation.
         return image_path, image, gt_boxes
 
 
+class SyntheticDetectionDataset(torch.utils.data.Dataset):
+    """
+    Synthetic detection dataset that serves the same `(image_path, image,
+    gt_boxes)` samples (and padding convention) as `VOC2007DetectionTiny`,
+    without any files: useful to measure throughput of the data pipeline and
+    model anywhere. Every image is a flat background with solid rectangles,
+    one per object, colored by class. Samples are generated lazily, and are
+    deterministic given `seed` and index.
+    """
+
+    def __init__(
+        self,
+        num_images: int = 10000,
+        image_size: Union[int, Tuple[int, int]] = 224,
+        num_classes: int = 20,
+        objects_per_image: Tuple[int, int] = (1, 10),
+        box_size_range: Tuple[float, float] = (0.05, 0.5),
+        box_size_distribution: str = "uniform",
+        max_gt_boxes: Optional[int] = 40,
+        uint8_images: bool = False,
+        seed: int = 0,
+    ):
+        """
+        Args:
+            num_images: Number of images in dataset.
+            image_size: Size of images, an integer or `(height, width)`.
+            num_classes: Number of object classes.
+            objects_per_image: Inclusive range of the number of objects.
+            box_size_range: Range of box width and height, as fractions of
+                image width and height respectively.
+            box_size_distribution: Distribution of box width and height in
+                `box_size_range`, one of {"uniform", "log_uniform"}.
+            max_gt_boxes: Number of rows GT boxes are padded to (with -1), or
+                `None` to serve only real boxes, same as `VOC2007DetectionTiny`.
+            uint8_images: Whether to serve `uint8` images, not normalized.
+            seed: Random seed, samples only depend on this and their index.
+        """
+        super().__init__()
+        if box_size_distribution not in ("uniform", "log_uniform"):
+            raise ValueError(
+                f"Unknown box_size_distribution: {box_size_distribution}"
+            )
+        if isinstance(image_size, int):
+            image_size = (image_size, image_size)
+
+        self.num_images = num_images
+        self.image_size = image_size
+        self.num_classes = num_classes
+        self.objects_per_image = objects_per_image
+        self.box_size_range = box_size_range
+        self.box_size_distribution = box_size_distribution
+        self.max_gt_boxes = max_gt_boxes
+        self.uint8_images = uint8_images
+        self.seed = seed
+
+        self.idx_to_class = {_idx: f"class{_idx}" for _idx in range(num_classes)}
+        self.class_to_idx = {
+            _class: _idx for _idx, _class in self.idx_to_class.items()
+        }
+
+        # One fixed color per class.
+        palette_generator = torch.Generator().manual_seed(seed)
+        self.class_colors = torch.randint(
+            0, 256, (num_classes, 3), dtype=torch.uint8,
+            generator=palette_generator,
+        )
+
+    @property
+    def aspect_ratios(self) -> np.ndarray:
+        """Width / height of every image, shape `(N, )`."""
+        height, width = self.image_size
+        return np.full(self.num_images, width / height)
+
+    def __len__(self):
+        return self.num_images
+
+    def _sample_box_sizes(self, num_boxes: int, generator) -> torch.Tensor:
+        """Sample `(num_boxes, 2)` box `(width, height)` as image fractions."""
+        low, high = self.box_size_range
+        u = torch.rand(num_boxes, 2, generator=generator)
+        if self.box_size_distribution == "log_uniform":
+            low, high = math.log(low), math.log(high)
+            return torch.exp(low + (high - low) * u)
+        return low + (high - low) * u
+
+    def __getitem__(self, index: int):
+        generator = torch.Generator().manual_seed((self.seed << 32) + index)
+        height, width = self.image_size
+
+        min_objects, max_objects = self.objects_per_image
+        num_boxes = int(
+            torch.randint(min_objects, max_objects + 1, (1,), generator=generator)
+        )
+
+        # Integer box co-ordinates, so boxes match painted pixels exactly.
+        image_wh = torch.tensor([width, height])
+        box_wh = self._sample_box_sizes(num_boxes, generator) * image_wh
+        box_wh = box_wh.long().clamp(min=1)
+        box_xy = torch.rand(num_boxes, 2, generator=generator)
+        box_xy = (box_xy * (image_wh - box_wh + 1)).long()
+        classes = torch.randint(
+            0, self.num_classes, (num_boxes,), generator=generator
+        )
+
+        background = torch.randint(
+            0, 256, (3, 1, 1), dtype=torch.uint8, generator=generator
+        )
+        image = background.repeat(1, height, width)
+        colors = self.class_colors[classes][:, :, None, None]
+        for (x1, y1), (w, h), color in zip(
+            box_xy.tolist(), box_wh.tolist(), colors
+        ):
+            image[:, y1 : y1 + h, x1 : x1 + w] = color
+        if not self.uint8_images:
+            image = normalize_images(image)
+
+        gt_boxes = torch.cat(
+            [box_xy, box_xy + box_wh, classes[:, None]], dim=1
+        ).float()
+
+        image_path = f"synthetic/{index:08d}.jpg"
+        if self.max_gt_boxes is not None:
+            if num_boxes > self.max_gt_boxes:
+                raise ValueError(
+                    f"{image_path} has {num_boxes} GT boxes, more than "
+                    f"max_gt_boxes = {self.max_gt_boxes}."
+                )
+            num_padding = self.max_gt_boxes - num_boxes
+            gt_boxes = torch.cat(
+                [gt_boxes, torch.zeros(num_padding, 5).fill_(-1.0)]
+            )
+        return image_path, image, gt_boxes
+
+
+def _tar_index_path(tar_path: str) -> str:
+    return f"{tar_path}.index.npz"
+
+
+def build_voc_tar_index(tar_path: str):
+    """
+    One-time scan of a (uncompressed) VOC tar file to build the random-access
+    index used by `VOC2007DetectionTiny(..., from_tar=True)`. For every JPEG
+    member, saves its name, byte offset and size of its data in the tar file,
+    and `(width, height)` of the image, to `<tar_path>.index.npz`. Only the
+    tar headers and JPEG headers are read, not the whole archive.
+    """
+    names, data_offsets, data_sizes, image_sizes = [], [], [], []
+    with tarfile.open(tar_path) as voc_tar:
+        for member in voc_tar:
+            if not (member.isfile() and member.name.endswith(".jpg")):
+                continue
+            with Image.open(voc_tar.extractfile(member)) as image:
+                image_sizes.append(image.size)
+            names.append(member.name.encode())
+            data_offsets.append(member.offset_data)
+            data_sizes.append(member.size)
+
+    name_offsets = np.zeros(len(names) + 1, dtype=np.int64)
+    name_offsets[1:] = np.cumsum([len(name) for name in names])
+    np.savez(
+        _tar_index_path(tar_path),
+        names=np.frombuffer(b"".join(names), dtype=np.uint8),
+        name_offsets=name_offsets,
+        data_offsets=np.array(data_offsets, dtype=np.int64),
+        data_sizes=np.array(data_sizes, dtype=np.int64),
+        image_sizes=np.array(image_sizes, dtype=np.int64).reshape(-1, 2),
+    )
+
+
+def _shard_index_path(shard_path: str) -> str:
+    return f"{shard_path}.index.npz"
+
+
+def pack_voc_shard(
+    dataset_dir: str,
+    split: str,
+    shard_path: str,
+    image_size: int = 224,
+    center_crop: bool = True,
+    from_tar: bool = False,
+):
+    """
+    Offline packing step for `VOC2007DetectionTiny(..., shard_path=...)`:
+    decode, resize and crop every image of a split once, and write them as
+    contiguous `uint8` CHW arrays into a single file at `shard_path`. Byte
+    offsets, shapes and original image sizes are saved in an index file
+    next to it (`<shard_path>.index.npz`).
+    """
+    dataset = VOC2007DetectionTiny(
+        dataset_dir,
+        split,
+        image_size=image_size,
+        center_crop=center_crop,
+        from_tar=from_tar,
+    )
+
+    num_images = len(dataset)
+    offsets = np.zeros(num_images + 1, dtype=np.int64)
+    shapes = np.zeros((num_images, 3), dtype=np.int64)
+    original_sizes = np.zeros((num_images, 2), dtype=np.int64)
+
+    with open(shard_path, "wb") as f_shard:
+        for index in range(num_images):
+            original_sizes[index] = dataset._original_sizes[index]
+
+            # HWC -> CHW, same layout as `transforms.ToTensor`.
+            image = np.asarray(dataset._load_image(index), dtype=np.uint8)
+            image = np.ascontiguousarray(image.transpose(2, 0, 1))
+            f_shard.write(image.tobytes())
+
+            shapes[index] = image.shape
+            offsets[index + 1] = offsets[index] + image.size
+
+    np.savez(
+        _shard_index_path(shard_path),
+        offsets=offsets,
+        shapes=shapes,
+        original_sizes=original_sizes,
+        image_size=np.int64(image_size),
+        center_crop=np.bool_(center_crop),
+    )
+
+
+class VOCMeanAPEvaluator:
+    """
+    In-process PASCAL VOC mean average precision (mAP) evaluator. Predictions
+    and GT boxes are accumulated batch by batch with `update`, in tensors
+    preallocated (and grown by doubling) on CPU. `compute` matches them per
+    class with vectorized IoU, and gives all-point interpolated AP per class,
+    same as the VOC 2010+ devkit (and the `mAP/` scripts used before).
+    Boxes are real-valued: IoU does not use the "+1 pixel" convention.
+    """
+
+    # Number of predictions matched with GT boxes at once in `compute`.
+    MATCH_CHUNK_SIZE = 4096
+
+    def __init__(
+        self, num_classes: int, iou_threshold: float = 0.5, capacity: int = 4096
+    ):
+        """
+        Args:
+            num_classes: Number of object classes, class IDs are in
+                `[0, num_classes)`.
+            iou_threshold: A prediction matches a GT box if their IoU is
+                strictly above this (as in the VOC devkit).
+            capacity: Initial number of predictions (and GT boxes) that can
+                be stored before buffers are grown.
+        """
+        self.num_classes = num_classes
+        self.iou_threshold = iou_threshold
+        self._capacity = capacity
+        self.reset()
+
+    def reset(self):
+        """Discard all accumulated predictions and GT boxes."""
+        # Rows of `(image_id, x1, y1, x2, y2, class, score)`.
+        self._preds = torch.empty(self._capacity, 7)
+        # Rows of `(image_id, x1, y1, x2, y2, class)`.
+        self._gts = torch.empty(self._capacity, 6)
+        self._num_preds = 0
+        self._num_gts = 0
+        self.num_images = 0
+
+    @staticmethod
+    def _append(buffer: torch.Tensor, size: int, rows: torch.Tensor):
+        if size + rows.shape[0] > buffer.shape[0]:
+            new_buffer = buffer.new_empty(
+                max(2 * buffer.shape[0], size + rows.shape[0]), buffer.shape[1]
+            )
+            new_buffer[:size] = buffer[:size]
+            buffer = new_buffer
+        buffer[size : size + rows.shape[0]] = rows
+        return buffer, size + rows.shape[0]
+
+    @staticmethod
+    def _with_image_id(rows: torch.Tensor, image_id: int) -> torch.Tensor:
+        image_ids = rows.new_full((rows.shape[0], 1), image_id)
+        return torch.cat([image_ids, rows], dim=1)
+
+    def update(
+        self,
+        pred_boxes: List[torch.Tensor],
+        gt_boxes: Union[List[torch.Tensor], torch.Tensor, PackedBoxes],
+    ):
+        """
+        Add predictions and GT boxes of a batch of images.
+        Args:
+            pred_boxes: Predictions of every image, tensors of shape `(N, 6)`
+                giving `(x1, y1, x2, y2, class, score)`.
+            gt_boxes: GT boxes of every image, tensors of shape `(M, 5)`
+                giving `(x1, y1, x2, y2, class)`; padding boxes (-1) are
+                ignored. A padded `(B, M, 5)` tensor or `PackedBoxes` also
+                work.
+        """
+        if isinstance(gt_boxes, PackedBoxes):
+            gt_boxes = gt_boxes.unbind()
+        if len(pred_boxes) == 0:
+            return
+        if len(pred_boxes) != len(gt_boxes):
+            raise ValueError(
+                f"Got predictions of {len(pred_boxes)} images and GT boxes of "
+                f"{len(gt_boxes)} images."
+            )
+
+        preds, gts = [], []
+        for image_preds, image_gts in zip(pred_boxes, gt_boxes):
+            image_preds = image_preds.detach().float().cpu()
+            image_gts = image_gts.detach().float().cpu()
+            image_gts = image_gts[image_gts[:, 4] != -1]
+
+            preds.append(self._with_image_id(image_preds, self.num_images))
+            gts.append(self._with_image_id(image_gts, self.num_images))
+            self.num_images += 1
+
+        self._preds, self._num_preds = self._append(
+            self._preds, self._num_preds, torch.cat(preds)
+        )
+        self._gts, self._num_gts = self._append(
+            self._gts, self._num_gts, torch.cat(gts)
+        )
+
+    def merge(self, other: "VOCMeanAPEvaluator"):
+        """
+        Add all predictions and GT boxes of `other` (e.g. evaluated on a
+        different shard of the dataset), after images of this evaluator.
+        """
+        preds = other._preds[: other._num_preds].clone()
+        gts = other._gts[: other._num_gts].clone()
+        preds[:, 0] += self.num_images
+        gts[:, 0] += self.num_images
+
+        self._preds, self._num_preds = self._append(
+            self._preds, self._num_preds, preds
+        )
+        self._gts, self._num_gts = self._append(self._gts, self._num_gts, gts)
+        self.num_images += other.num_images
+
+    def _class_average_precision(
+        self, preds: torch.Tensor, gts: torch.Tensor
+    ) -> float:
+        """
+        AP of one class, given its predictions `(P, 7)` and GT boxes `(G, 6)`
+        (rows as stored in `update`). `G` must be non-zero.
+        """
+        if preds.shape[0] == 0:
+            return 0.0
+        order = torch.sort(preds[:, 6], descending=True, stable=True)[1]
+        preds = preds[order]
+
+        # Every prediction is matched with the GT box of its image that has
+        # highest IoU with it, if that IoU is strictly above the threshold.
+        matched_gt = torch.full((preds.shape[0],), -1, dtype=torch.long)
+        for start in range(0, preds.shape[0], self.MATCH_CHUNK_SIZE):
+            chunk = preds[start : start + self.MATCH_CHUNK_SIZE]
+            iou = box_iou(chunk[:, 1:5], gts[:, 1:5])
+            iou[chunk[:, 0, None] != gts[None, :, 0]] = -1
+            best_iou, best_gt = iou.max(dim=1)
+            matched_gt[start : start + chunk.shape[0]] = best_gt.masked_fill(
+                best_iou <= self.iou_threshold, -1
+            )
+
+        # Greedy VOC matching: a GT box is detected by its highest scoring
+        # matched prediction, others matched with it are false positives.
+        is_matched = matched_gt >= 0
+        pred_ids = torch.arange(preds.shape[0])
+        first_pred_of_gt = torch.full((gts.shape[0],), preds.shape[0])
+        first_pred_of_gt = first_pred_of_gt.scatter_reduce(
+            0, matched_gt[is_matched], pred_ids[is_matched], reduce="amin"
+        )
+        true_positives = is_matched.clone()
+        true_positives[is_matched] = (
+            first_pred_of_gt[matched_gt[is_matched]] == pred_ids[is_matched]
+        )
+
+        num_true_positives = true_positives.cumsum(dim=0).double()
+        recall = num_true_positives / gts.shape[0]
+        precision = num_true_positives / (pred_ids + 1).double()
+
+        # All-point interpolation: area under the precision envelope (the
+        # max precision at any higher recall) across recall steps.
+        precision = precision.flip(0).cummax(dim=0).values.flip(0)
+        recall_steps = torch.diff(recall, prepend=recall.new_zeros(1))
+        return float((recall_steps * precision).sum())
+
+    def compute(self) -> Dict[str, Union[float, Dict[int, float]]]:
+        """
+        Returns:
+            Dictionary with keys "mAP" giving the mean of AP across classes
+            that have GT boxes, and "AP" giving a dictionary of AP per class
+            ID (classes without GT boxes are skipped).
+        """
+        preds = self._preds[: self._num_preds]
+        gts = self._gts[: self._num_gts]
+        pred_classes = preds[:, 5].long()
+        gt_classes = gts[:, 5].long()
+
+        average_precision = {}
+        for class_id in gt_classes.unique().tolist():
+            average_precision[class_id] = self._class_average_precision(
+                preds[pred_classes == class_id], gts[gt_classes == class_id]
+            )
+        mean_ap = (
+            sum(average_precision.values()) / len(average_precision)
+            if average_precision
+            else 0.0
+        )
+        return {"mAP": mean_ap, "AP": average_precision}
+
+
+# Columns of detection results written by `DetectionResultsWriter`: name,
+# NumPy dtype and shape of a single row.
+DETECTION_RESULT_COLUMNS = (
+    ("image_ids", np.int32, ()),
+    ("boxes", np.float32, (4,)),
+    ("classes", np.int32, ()),
+    ("scores", np.float32, ()),
+)
+
+
+class DetectionResults(NamedTuple):
+    """
+    Detection results read by `read_detection_results`. Columns are arrays
+    memory-mapped from disk, row `i` is one detection in image
+    `image_paths[image_ids[i]]`.
+    """
+
+    image_ids: np.ndarray  # `(N, )`
+    boxes: np.ndarray  # `(N, 4)` giving XYXY co-ordinates.
+    classes: np.ndarray  # `(N, )`
+    scores: np.ndarray  # `(N, )`
+    image_paths: List[str]
+
+
+class DetectionResultsWriter:
+    """
+    Append detections to a columnar binary format in `output_dir`: one raw
+    file per column (see `DETECTION_RESULT_COLUMNS`), and `meta.json` giving
+    the number of rows and image paths (written by `close`). Detections are
+    buffered into chunks of `chunk_size` rows, which a background thread
+    appends to column files, so callers never block on disk I/O (unless
+    `max_pending_chunks` are waiting). Use `read_detection_results` to
+    memory-map the results.
+    """
+
+    def __init__(
+        self,
+        output_dir: str,
+        chunk_size: int = 65536,
+        max_pending_chunks: int = 4,
+    ):
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.chunk_size = chunk_size
+        self.image_paths = []
+
+        # Metadata of earlier results would describe the new column files.
+        meta_path = os.path.join(output_dir, "meta.json")
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+
+        self._buffer = {name: [] for name, _, _ in DETECTION_RESULT_COLUMNS}
+        self._buffered_rows = 0
+        self._num_rows = 0
+        self._error = None
+        self._aborted = False
+
+        self._files = {
+            name: open(os.path.join(output_dir, f"{name}.bin"), "wb")
+            for name, _, _ in DETECTION_RESULT_COLUMNS
+        }
+        self._queue = queue.Queue(maxsize=max_pending_chunks)
+        self._thread = threading.Thread(target=self._write_chunks, daemon=True)
+        self._thread.start()
+
+    def _write_chunks(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                return
+            if self._error is not None or self._aborted:
+                continue
+            try:
+                for name, column in chunk.items():
+                    self._files[name].write(column.tobytes())
+            except Exception as error:
+                self._error = error
+
+    def _check_error(self):
+        if self._error is not None:
+            raise RuntimeError(
+                f"Writing detection results to {self.output_dir} failed."
+            ) from self._error
+
+    def _flush(self):
+        if self._buffered_rows == 0:
+            return
+        chunk = {
+            name: np.concatenate(self._buffer[name]).astype(dtype, copy=False)
+            for name, dtype, _ in DETECTION_RESULT_COLUMNS
+        }
+        self._buffer = {name: [] for name in self._buffer}
+        self._num_rows += self._buffered_rows
+        self._buffered_rows = 0
+        self._queue.put(chunk)
+
+    def append(self, image_paths: List[str], pred_boxes: List[torch.Tensor]):
+        """
+        Add detections of a batch of images.
+        Args:
+            image_paths: Paths of images in the batch.
+            pred_boxes: Detections of every image, tensors of shape `(N, 6)`
+                giving `(x1, y1, x2, y2, class, score)`.
+        """
+        self._check_error()
+        for image_path, image_preds in zip(image_paths, pred_boxes):
+            image_preds = image_preds.detach().cpu().numpy()
+            image_id = len(self.image_paths)
+            self.image_paths.append(image_path)
+
+            num_preds = image_preds.shape[0]
+            self._buffer["image_ids"].append(np.full(num_preds, image_id))
+            self._buffer["boxes"].append(image_preds[:, :4])
+            self._buffer["classes"].append(image_preds[:, 4])
+            self._buffer["scores"].append(image_preds[:, 5])
+            self._buffered_rows += num_preds
+
+        if self._buffered_rows >= self.chunk_size:
+            self._flush()
+
+    def _stop(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        for f in self._files.values():
+            f.close()
+
+    def close(self):
+        """Write remaining detections and metadata, and wait for the writer."""
+        if self._thread is None:
+            return
+        self._flush()
+        self._stop()
+        self._check_error()
+
+        with open(os.path.join(self.output_dir, "meta.json"), "w") as f:
+            json.dump(
+                {"num_rows": self._num_rows, "image_paths": self.image_paths}, f
+            )
+
+    def abort(self):
+        """
+        Stop the writer, discarding detections not written yet. No metadata
+        is written, so partial results can not be read.
+        """
+        if self._thread is None:
+            return
+        self._aborted = True
+        self._stop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def read_detection_results(output_dir: str) -> DetectionResults:
+    """Memory-map detection results written by `DetectionResultsWriter`."""
+    with open(os.path.join(output_dir, "meta.json")) as f:
+        meta = json.load(f)
+
+    columns = {}
+    for name, dtype, row_shape in DETECTION_RESULT_COLUMNS:
+        shape = (meta["num_rows"], *row_shape)
+        if meta["num_rows"] == 0:
+            # Empty files can not be memory-mapped.
+            columns[name] = np.empty(shape, dtype=dtype)
+        else:
+            columns[name] = np.memmap(
+                os.path.join(output_dir, f"{name}.bin"),
+                dtype=dtype,
+                mode="r",
+                shape=shape,
+            )
+    return DetectionResults(image_paths=meta["image_paths"], **columns)
+
+
 def infinite_loader(loader):
     """Get an infinite stream of batches from a data loader."""
     while True:
@@ -221,14 +1371,21 @@ def train_detector(
     detector.train()
 
     for _iter in range(max_iters):
-        # Ignore first arg (image path) during training.
-        _, images, gt_boxes = next(train_loader)
+        # Ignore first arg (image path) during training. Batches may also have
+        # training targets computed by DataLoader workers (`FCOSTargetDataset`).
+        _, images, gt_boxes, *extras = next(train_loader)
 
         images = images.to(device)
         gt_boxes = gt_boxes.to(device)
+        if images.dtype == torch.uint8:
+            images = normalize_images(images)
 
         # Dictionary of loss scalars.
-        losses = detector(images, gt_boxes)
+        if extras:
+            gt_targets = {k: v.to(device) for k, v in extras[0].items()}
+            losses = detector(images, gt_boxes, gt_targets=gt_targets)
+        else:
+            losses = detector(images, gt_boxes)
 
         # Ignore keys like "proposals" in RPN.
         losses = {k: v for k, v in losses.items() if "loss" in k}
@@ -256,6 +1413,164 @@ def train_detector(
     plt.show()
 
 
+def prepare_images(
+    images: torch.Tensor, dtype: torch.dtype, device: str
+) -> torch.Tensor:
+    """Move a batch of images to `device`, normalizing `uint8` images."""
+    images = images.to(device=device)
+    if images.dtype == torch.uint8:
+        return normalize_images(images, dtype=dtype)
+    return images.to(dtype=dtype)
+
+
+def _detect_batch(
+    detector, images: torch.Tensor, score_thresh: float, nms_thresh: float
+) -> List[torch.Tensor]:
+    """
+    Run `detector` (in eval mode) on a batch of images. Returns CPU tensors of
+    shape `(N, 6)` per image, giving `(x1, y1, x2, y2, class, score)`.
+    """
+    with torch.no_grad():
+        # One tuple per image, shapes:
+        # (num_preds, 4) (num_preds, ) (num_preds, )
+        preds_per_image = detector(
+            images,
+            test_score_thresh=score_thresh,
+            test_nms_thresh=nms_thresh,
+            test_per_image=True,
+        )
+
+    # Combine predicted classes and scores into boxes for evaluation
+    # and visualization, and transfer them to CPU.
+    pred_boxes_per_image = []
+    for pred_boxes, pred_classes, pred_scores in preds_per_image:
+        valid_pred = pred_classes != -1
+        pred_boxes_per_image.append(
+            torch.cat(
+                [
+                    pred_boxes[valid_pred],
+                    pred_classes[valid_pred].unsqueeze(1).to(pred_boxes),
+                    pred_scores[valid_pred].unsqueeze(1),
+                ],
+                dim=1,
+            ).cpu()
+        )
+    return pred_boxes_per_image
+
+
+# Detector and dataset of a worker process of `evaluate_detector_sharded`,
+# set once per process by `_init_shard_worker`.
+_shard_worker_state = {}
+
+
+def _init_shard_worker(detector, dataset, dtype: torch.dtype, num_threads: int):
+    # One intra-op thread pool per process, sized to its share of cores.
+    cs639.utils.set_cpu_threads(num_threads, 1)
+    detector.to(dtype=dtype, device="cpu")
+    detector.eval()
+    _shard_worker_state.update(detector=detector, dataset=dataset, dtype=dtype)
+
+
+def _evaluate_shard(
+    indices: List[int],
+    batch_size: int,
+    collate_fn,
+    score_thresh: float,
+    nms_thresh: float,
+    evaluator: VOCMeanAPEvaluator,
+) -> VOCMeanAPEvaluator:
+    """Worker of `evaluate_detector_sharded`: evaluate one shard on CPU."""
+    detector = _shard_worker_state["detector"]
+    dtype = _shard_worker_state["dtype"]
+
+    loader = torch.utils.data.DataLoader(
+        torch.utils.data.Subset(_shard_worker_state["dataset"], indices),
+        batch_size=batch_size,
+        shuffle=False,
+        collate_fn=collate_fn,
+    )
+    for _, images, gt_boxes, *_ in loader:
+        images = prepare_images(images, dtype, "cpu")
+        evaluator.update(
+            _detect_batch(detector, images, score_thresh, nms_thresh), gt_boxes
+        )
+    return evaluator
+
+
+def evaluate_detector_sharded(
+    detector,
+    dataset,
+    num_classes: int,
+    score_thresh: float,
+    nms_thresh: float,
+    num_processes: Optional[int] = None,
+    batch_size: int = 8,
+    collate_fn=None,
+    dtype: torch.dtype = torch.float32,
+    num_threads_per_process: Optional[int] = None,
+    iou_threshold: float = 0.5,
+) -> Dict[str, Union[float, Dict[int, float]]]:
+    """
+    Evaluate `detector` on `dataset` with `num_processes` CPU processes (one
+    per core by default), each running its own model replica over a
+    contiguous shard of the dataset, with `num_threads_per_process` PyTorch
+    threads (cores split evenly by default). Processes are spawned, so
+    `detector` and `dataset` must be picklable; they are sent once per
+    process, at its start. Locks in them must come from the "spawn"
+    multiprocessing context, as in `SharedImageCache`; a default ("fork")
+    lock can not be sent to spawned processes. `detector` is moved to CPU.
+    Per-shard results are merged in dataset order, so the mAP is the same
+    for any number of processes. Returns results of
+    `VOCMeanAPEvaluator.compute`.
+    """
+    num_cpus = os.cpu_count() or 1
+    num_processes = min(num_processes or num_cpus, len(dataset))
+    if num_threads_per_process is None:
+        num_threads_per_process = max(num_cpus // num_processes, 1)
+    collate_fn = collate_fn or DetectionCollate()
+
+    # Contiguous shards, sizes differ by at most one.
+    shard_sizes = [
+        len(dataset) // num_processes + (i < len(dataset) % num_processes)
+        for i in range(num_processes)
+    ]
+    shard_starts = np.cumsum([0] + shard_sizes).tolist()
+
+    start_t = time.time()
+    # Do not send CUDA tensors to CPU worker processes.
+    detector.to(device="cpu")
+    # fmt: off
+    shard_args = [
+        (
+            list(range(start, start + size)), batch_size, collate_fn,
+            score_thresh, nms_thresh,
+            VOCMeanAPEvaluator(num_classes, iou_threshold=iou_threshold),
+        )
+        for start, size in zip(shard_starts, shard_sizes)
+    ]
+    # fmt: on
+    context = torch.multiprocessing.get_context("spawn")
+    with context.Pool(
+        num_processes,
+        initializer=_init_shard_worker,
+        initargs=(detector, dataset, dtype, num_threads_per_process),
+    ) as pool:
+        # `starmap` returns shard results in order of shards.
+        shard_evaluators = pool.starmap(_evaluate_shard, shard_args)
+
+    evaluator = VOCMeanAPEvaluator(num_classes, iou_threshold=iou_threshold)
+    for shard_evaluator in shard_evaluators:
+        evaluator.merge(shard_evaluator)
+    results = evaluator.compute()
+
+    end_t = time.time()
+    print(
+        f"Total inference time: {end_t-start_t:.1f}s "
+        f"({num_processes} processes x {num_threads_per_process} threads)"
+    )
+    return results
+
+
 def inference_with_detector(
     detector,
     test_loader,
@@ -265,7 +1580,32 @@ def inference_with_detector(
     output_dir: Optional[str] = None,
     dtype: torch.dtype = torch.float32,
     device:str = "cpu",
+    num_threads: Optional[int] = None,
+    num_interop_threads: Optional[int] = None,
+    evaluator: Optional[VOCMeanAPEvaluator] = None,
+    results_format: str = "txt",
+    visualize_dir: Optional[str] = None,
 ):
+    """
+    Run inference on `test_loader`, then either write detections to files in
+    `output_dir` for evaluation, or visualize them. For CPU inference, set
+    `num_threads` and `num_interop_threads` to control the threads used by
+    PyTorch (e.g. to run several processes per socket).
+    If `evaluator` is given, detections are evaluated in-process instead (no
+    files are written and nothing is visualized): per-class AP and mAP are
+    printed, and the results of `evaluator.compute()` are returned.
+    With `results_format="txt"`, `output_dir` gets one text file per image
+    in `detection-results` and `ground-truth` (for the external mAP script).
+    With "columnar", detections of all images are written in the background
+    to `output_dir/detections` (see `DetectionResultsWriter`).
+    Without `output_dir`, detections are shown inline with matplotlib, or if
+    `visualize_dir` is given, rendered to image files there by a pool of
+    worker processes (see `cs639.utils.DetectionRenderPool`).
+    """
+    if results_format not in ("txt", "columnar"):
+        raise ValueError(f"Unknown results_format {results_format!r}")
+
+    cs639.utils.set_cpu_threads(num_threads, num_interop_threads)
 
     # ship model to GPU
     detector.to(dtype=dtype, device=device)
@@ -286,72 +1626,109 @@ def inference_with_detector(
         ]
     )
 
-    if output_dir is not None:
-        det_dir = "mAP/input/detection-results"
-        gt_dir = "mAP/input/ground-truth"
-        if os.path.exists(det_dir):
-            shutil.rmtree(det_dir)
-        os.mkdir(det_dir)
-        if os.path.exists(gt_dir):
-            shutil.rmtree(gt_dir)
-        os.mkdir(gt_dir)
-
-    for iter_num, test_batch in enumerate(test_loader):
-        image_paths, images, gt_boxes = test_batch
-        images = images.to(dtype=dtype, device=device)
-
-        with torch.no_grad():
-            if score_thresh is not None and nms_thresh is not None:
-                # shapes: (num_preds, 4) (num_preds, ) (num_preds, )
-                pred_boxes, pred_classes, pred_scores = detector(
-                    images,
-                    test_score_thresh=score_thresh,
-                    test_nms_thresh=nms_thresh,
-                )
+    results_writer = None
+    if output_dir is not None and evaluator is None:
+        if results_format == "columnar":
+            results_writer = DetectionResultsWriter(
+                os.path.join(output_dir, "detections")
+            )
+        else:
+            det_dir = os.path.join(output_dir, "detection-results")
+            gt_dir = os.path.join(output_dir, "ground-truth")
+            if os.path.exists(det_dir):
+                shutil.rmtree(det_dir)
+            os.makedirs(det_dir)
+            if os.path.exists(gt_dir):
+                shutil.rmtree(gt_dir)
+            os.makedirs(gt_dir)
 
-        # Skip current iteration if no predictions were found.
-        if pred_boxes.shape[0] == 0:
-            continue
+    render_pool = None
+    if output_dir is None and evaluator is None and visualize_dir is not None:
+        render_pool = cs639.utils.DetectionRenderPool(visualize_dir, idx_to_class)
 
-        # Remove padding (-1) and batch dimension from predicted / GT boxes
-        # and transfer to CPU. Indexing `[0]` here removes batch dimension:
-        gt_boxes = gt_boxes[0]
-        valid_gt = gt_boxes[:, 4] != -1
-        gt_boxes = gt_boxes[valid_gt].cpu()
+    try:
+        for iter_num, test_batch in enumerate(test_loader):
+            image_paths, images, gt_boxes, *_ = test_batch
+            images = prepare_images(images, dtype, device)
+            pred_boxes_per_image = _detect_batch(
+                detector, images, score_thresh, nms_thresh
+            )
 
-        valid_pred = pred_classes != -1
-        pred_boxes = pred_boxes[valid_pred].cpu()
-        pred_classes = pred_classes[valid_pred].cpu()
-        pred_scores = pred_scores[valid_pred].cpu()
-
-        image_path = image_paths[0]
-        # Un-normalize image tensor for visualization.
-        image = inverse_norm(images[0]).cpu()
-
-        # Combine predicted classes and scores into boxes for evaluation
-        # and visualization.
-        pred_boxes = torch.cat(
-            [pred_boxes, pred_classes.unsqueeze(1), pred_scores.unsqueeze(1)], dim=1
-        )
+            # GT boxes per image, padding (-1) is removed below.
+            if isinstance(gt_boxes, PackedBoxes):
+                gt_boxes = gt_boxes.unbind()
+
+            if evaluator is not None:
+                # All images count for mAP, even those without predictions.
+                evaluator.update(pred_boxes_per_image, gt_boxes)
+                continue
+            if results_writer is not None:
+                results_writer.append(image_paths, pred_boxes_per_image)
+                continue
+            if render_pool is not None:
+                # Un-normalize the whole batch to uint8 HWC images, to render.
+                render_images = inverse_norm(images).clamp(0, 1) * 255
+                render_images = render_images.to(torch.uint8).permute(0, 2, 3, 1)
+                render_images = render_images.cpu().numpy()
+
+            for image_idx, pred_boxes in enumerate(pred_boxes_per_image):
+                # Skip current image if no predictions were found.
+                if pred_boxes.shape[0] == 0:
+                    continue
+
+                # Transfer GT boxes of this image to CPU.
+                image_gt_boxes = gt_boxes[image_idx]
+                valid_gt = image_gt_boxes[:, 4] != -1
+                image_gt_boxes = image_gt_boxes[valid_gt].cpu()
 
-        # write results to file for evaluation (use mAP API https://github.com/Cartucho/mAP for now...)
-        if output_dir is not None:
-            file_name = os.path.basename(image_path).replace(".jpg", ".txt")
-            with open(os.path.join(det_dir, file_name), "w") as f_det, open(
-                os.path.join(gt_dir, file_name), "w"
-            ) as f_gt:
-                for b in gt_boxes:
-                    f_gt.write(
-                        f"{idx_to_class[b[4].item()]} {b[0]:.2f} {b[1]:.2f} {b[2]:.2f} {b[3]:.2f}\n"
+                image_path = image_paths[image_idx]
+
+                # write results to file for evaluation (use mAP API https://github.com/Cartucho/mAP for now...)
+                if output_dir is not None:
+                    file_name = os.path.basename(image_path).replace(".jpg", ".txt")
+                    with open(os.path.join(det_dir, file_name), "w") as f_det, open(
+                        os.path.join(gt_dir, file_name), "w"
+                    ) as f_gt:
+                        for b in image_gt_boxes:
+                            f_gt.write(
+                                f"{idx_to_class[b[4].item()]} {b[0]:.2f} {b[1]:.2f} {b[2]:.2f} {b[3]:.2f}\n"
+                            )
+                        for b in pred_boxes:
+                            f_det.write(
+                                f"{idx_to_class[b[4].item()]} {b[5]:.6f} {b[0]:.2f} {b[1]:.2f} {b[2]:.2f} {b[3]:.2f}\n"
+                            )
+                elif render_pool is not None:
+                    render_pool.submit(
+                        os.path.basename(image_path),
+                        render_images[image_idx],
+                        image_gt_boxes,
+                        pred_boxes,
                     )
-                for b in pred_boxes:
-                    f_det.write(
-                        f"{idx_to_class[b[4].item()]} {b[5]:.6f} {b[0]:.2f} {b[1]:.2f} {b[2]:.2f} {b[3]:.2f}\n"
+                else:
+                    # Un-normalize image tensor for visualization.
+                    image = inverse_norm(images[image_idx]).cpu()
+                    cs639.utils.detection_visualizer(
+                        image, idx_to_class, image_gt_boxes, pred_boxes
                     )
-        else:
-            cs639.utils.detection_visualizer(
-                image, idx_to_class, gt_boxes, pred_boxes
-            )
+    except BaseException:
+        # Do not leave rendering workers or the results writer running.
+        if render_pool is not None:
+            render_pool.terminate()
+        if results_writer is not None:
+            results_writer.abort()
+        raise
+
+    if results_writer is not None:
+        results_writer.close()
+    if render_pool is not None:
+        render_pool.close()
 
     end_t = time.time()
     print(f"Total inference time: {end_t-start_t:.1f}s")
+
+    if evaluator is not None:
+        results = evaluator.compute()
+        for class_id, class_ap in sorted(results["AP"].items()):
+            print(f"AP {idx_to_class[class_id]}: {100 * class_ap:.2f}")
+        print(f"mAP: {100 * results['mAP']:.2f}")
+        return results
@@ -1,4 +1,8 @@
+import multiprocessing
+import os
+import queue
 import random
+import traceback
 
 import cv2
 import matplotlib as mpl
@@ -24,7 +28,25 @@ def reset_seed(number):
     return
 
 
+def set_cpu_threads(num_threads=None, num_interop_threads=None):
+    """
+    Set the number of threads PyTorch uses for CPU execution. Use a few threads
+    per process to run several model replicas per socket, instead of one
+    replica that uses every core.
 
+    Inputs:
+    - num_threads: Number of threads used within an op (intra-op), optional
+    - num_interop_threads: Number of threads used to run independent ops in
+      parallel (inter-op), optional. This can only be set once per process,
+      before any inter-op parallel work has started.
+    """
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    if (
+        num_interop_threads is not None
+        and torch.get_num_interop_threads() != num_interop_threads
+    ):
+        torch.set_num_interop_threads(num_interop_threads)
 
 
 def detection_visualizer(img, idx_to_class, bbox=None, pred=None, points=None):
@@ -113,4 +135,185 @@ def detection_visualizer(img, idx_to_class, bbox=None, pred=None, points=None):
                     zorder=10,
                 )
     # fmt: on
-    plt.show()
\ No newline at end of file
+    plt.show()
+
+
+def render_detections(img, idx_to_class, bbox=None, pred=None):
+    """
+    Draw boxes straight onto a copy of an image with OpenCV, same colors as
+    `detection_visualizer`. Much faster than a matplotlib figure, use it to
+    render many images (see `DetectionRenderPool`).
+
+    Inputs:
+    - img: uint8 numpy array of shape HxWx3 (RGB)
+    - idx_to_class: Mapping from the index (0-19) to the class name
+    - bbox: GT bbox (in red, optional), numpy array of shape Nx5, see
+            `detection_visualizer`
+    - pred: Predicted bbox (in green, optional), numpy array of shape N'x6,
+            see `detection_visualizer`
+
+    Returns:
+    - Rendered uint8 numpy array of shape HxWx3 (RGB)
+    """
+    img = np.ascontiguousarray(img, dtype=np.uint8).copy()
+    font, font_scale = cv2.FONT_HERSHEY_SIMPLEX, 0.4
+
+    def draw(boxes, color, with_score):
+        for single_bbox in boxes:
+            x0, y0, x1, y1 = (int(round(float(c))) for c in single_bbox[:4])
+            cv2.rectangle(img, (x0, y0), (x1, y1), color, thickness=2)
+            if len(single_bbox) > 4:  # if class info provided
+                label = idx_to_class[int(single_bbox[4])]
+                if with_score:
+                    label = f"{label}, {float(single_bbox[5]):.2f}"
+                (w, h), baseline = cv2.getTextSize(label, font, font_scale, 1)
+                cv2.rectangle(
+                    img, (x0, y0), (x0 + w, y0 + h + baseline), (0, 0, 0), -1
+                )
+                cv2.putText(
+                    img, label, (x0, y0 + h), font, font_scale,
+                    (255, 255, 255), 1, cv2.LINE_AA,
+                )
+
+    if bbox is not None:
+        draw(bbox, (255, 0, 0), with_score=False)
+    if pred is not None:
+        draw(pred, (0, 255, 0), with_score=True)
+    return img
+
+
+def _render_worker(task_queue, error_queue, idx_to_class):
+    while True:
+        task = task_queue.get()
+        if task is None:
+            return
+        path, img, bbox, pred = task
+        # Report failures and keep going: a dead worker would leave the
+        # bounded task queue without consumers.
+        try:
+            img = render_detections(img, idx_to_class, bbox, pred)
+            if not cv2.imwrite(path, cv2.cvtColor(img, cv2.COLOR_RGB2BGR)):
+                raise IOError(f"cv2.imwrite could not write {path}")
+        except Exception:
+            error_queue.put(f"Rendering {path} failed:\n{traceback.format_exc()}")
+
+
+class DetectionRenderPool:
+    """
+    Render detections onto images (with `render_detections`) and write them
+    to `output_dir`, in a pool of `num_workers` processes. Work is handed over
+    through a queue of at most `max_pending` images, so the caller only
+    blocks when rendering falls that far behind. Use it as a context manager,
+    or call `close` to wait for all images to be written.
+    Errors in workers are raised (as `RuntimeError`) by the next `submit`
+    or `close`.
+    """
+
+    # Seconds to wait on a full task queue before checking workers again.
+    _POLL_INTERVAL = 1.0
+
+    def __init__(
+        self, output_dir, idx_to_class, num_workers=None, max_pending=64
+    ):
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        if num_workers is None:
+            num_workers = min(4, os.cpu_count() or 1)
+
+        self._queue = multiprocessing.Queue(maxsize=max_pending)
+        self._errors = multiprocessing.Queue()
+        self._error_messages = []
+        self._workers = [
+            multiprocessing.Process(
+                target=_render_worker,
+                args=(self._queue, self._errors, dict(idx_to_class)),
+                daemon=True,
+            )
+            for _ in range(num_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def _drain_errors(self):
+        while True:
+            try:
+                self._error_messages.append(self._errors.get_nowait())
+            except queue.Empty:
+                return
+
+    def _check_errors(self):
+        self._drain_errors()
+        if self._error_messages:
+            errors, self._error_messages = self._error_messages, []
+            raise RuntimeError(
+                f"{len(errors)} image(s) could not be rendered, first error: "
+                f"{errors[0]}"
+            )
+        if self._workers and not any(w.is_alive() for w in self._workers):
+            raise RuntimeError("All rendering worker processes have exited.")
+
+    def _put(self, task):
+        # Never block indefinitely: re-check workers while the queue is full.
+        while True:
+            self._check_errors()
+            try:
+                self._queue.put(task, timeout=self._POLL_INTERVAL)
+                return
+            except queue.Full:
+                continue
+
+    def submit(self, file_name, img, bbox=None, pred=None):
+        """
+        Queue an image to render and write as `output_dir/file_name`. Inputs
+        are same as `render_detections`, tensors are converted to numpy.
+        """
+        if isinstance(bbox, torch.Tensor):
+            bbox = bbox.cpu().numpy()
+        if isinstance(pred, torch.Tensor):
+            pred = pred.cpu().numpy()
+        path = os.path.join(self.output_dir, file_name)
+        self._put((path, np.asarray(img), bbox, pred))
+
+    def close(self):
+        """
+        Wait for all queued images to be written, and stop workers. Raises
+        errors of any images that could not be rendered.
+        """
+        workers, self._workers = self._workers, []
+        try:
+            for worker in workers:
+                while worker.is_alive():
+                    try:
+                        self._queue.put(None, timeout=self._POLL_INTERVAL)
+                        break
+                    except queue.Full:
+                        self._drain_errors()
+                        if not any(w.is_alive() for w in workers):
+                            break
+            for worker in workers:
+                # Workers exit only after their errors are read.
+                while worker.is_alive():
+                    self._drain_errors()
+                    worker.join(timeout=self._POLL_INTERVAL)
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+        self._check_errors()
+
+    def terminate(self):
+        """Stop workers right away, discarding queued images."""
+        for worker in self._workers:
+            worker.terminate()
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()